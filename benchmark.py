@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+import json
+from optparse import OptionParser
+import os
+import platform
+import random
+import shutil
+from subprocess import check_call, check_output, run, DEVNULL, STDOUT
+import sys
+import tempfile
+import time
+
+from general import parse_size
+
+# A benchmark of gib's main operations.  This generates a synthetic
+# directory to back up (with nested git repositories, extended
+# attributes and a configurable number and size of files), backs it up
+# to a new repository in a temporary directory and times each of:
+#
+#   init, the first commit, each incremental commit (after changing
+#   some of the files), update-file-list, index, extract, restore and
+#   find-in-repository.py (with and without the index)
+#
+# The directory is generated from a random seed, so the same options
+# always produce the same files.  The results are appended to a JSON
+# history file, and compared with the last run that used the same
+# options, so that you can see whether a change made gib faster or
+# slower.  Nothing outside the temporary directory is touched, and
+# nothing is fetched over the network.
+
+gib_directory = os.path.dirname(os.path.abspath(__file__))
+
+parser = OptionParser(usage="Usage: %prog [OPTIONS]")
+parser.add_option('--files',
+                  dest="files",
+                  type="int",
+                  default=2000,
+                  help="the number of files to generate (default: %default)")
+parser.add_option('--size',
+                  dest="size",
+                  default="16K",
+                  help="the median size of each file, e.g. 4K (default: %default)")
+parser.add_option('--size-distribution',
+                  dest="size_distribution",
+                  choices=["fixed","uniform","lognormal"],
+                  default="lognormal",
+                  help="how the file sizes vary around the median: fixed, uniform (up to twice the median) or lognormal (default: %default)")
+parser.add_option('--depth',
+                  dest="depth",
+                  type="int",
+                  default=4,
+                  help="the maximum depth of the directories (default: %default)")
+parser.add_option('--fan-out',
+                  dest="fan_out",
+                  type="int",
+                  default=4,
+                  help="the number of subdirectories in each directory (default: %default)")
+parser.add_option('--repositories',
+                  dest="repositories",
+                  type="int",
+                  default=2,
+                  help="the number of nested git repositories (default: %default)")
+parser.add_option('--xattrs',
+                  dest="xattrs",
+                  type="float",
+                  default=0.1,
+                  help="the fraction of files with an extended attribute (default: %default)")
+parser.add_option('--churn',
+                  dest="churn",
+                  type="float",
+                  default=0.05,
+                  help="the fraction of files changed before each incremental commit (default: %default)")
+parser.add_option('--incremental-commits',
+                  dest="incremental_commits",
+                  type="int",
+                  default=2,
+                  help="the number of incremental commits to time (default: %default)")
+parser.add_option('--seed',
+                  dest="seed",
+                  type="int",
+                  default=0,
+                  help="the seed for generating the files (default: %default)")
+parser.add_option('--history',
+                  dest="history",
+                  default="benchmark-history.json",
+                  help="the file to add the results to (default: %default)")
+parser.add_option('--label',
+                  dest="label",
+                  default=None,
+                  help="a description of this run to store with the results")
+parser.add_option('--keep',
+                  dest="keep",
+                  action="store_true",
+                  default=False,
+                  help="don't remove the temporary directory at the end")
+
+options,args = parser.parse_args()
+
+if args:
+    parser.print_help()
+    sys.exit(1)
+
+try:
+    median_size = parse_size(options.size)
+except ValueError:
+    print("Couldn't understand the size '{}'".format(options.size),
+          file=sys.stderr)
+    sys.exit(1)
+
+rng = random.Random(options.seed)
+
+# Make sure that nothing in the user's own git configuration (or
+# identity) affects the results:
+environment = dict(os.environ)
+environment.update({
+    "GIT_CONFIG_NOSYSTEM": "1",
+    "GIT_AUTHOR_NAME": "gib benchmark",
+    "GIT_AUTHOR_EMAIL": "benchmark@example.com",
+    "GIT_COMMITTER_NAME": "gib benchmark",
+    "GIT_COMMITTER_EMAIL": "benchmark@example.com",
+})
+
+def file_size():
+    if options.size_distribution == "fixed":
+        return median_size
+    elif options.size_distribution == "uniform":
+        return rng.randint(0,2*median_size)
+    else:
+        return int(rng.lognormvariate(0,1.5) * median_size)
+
+def file_contents(size):
+    # Half of each file is random and half is repeated, so that the
+    # files compress about as well as typical data:
+    random_part = rng.randbytes(size // 2)
+    return random_part + b"abcdefgh" * ((size - len(random_part)) // 8 + 1)
+
+def generate_directories(top):
+    '''Return a list of the directories (including "top") in a tree of
+    the configured depth and fan-out, creating them'''
+    directories = [ top ]
+    level = [ top ]
+    for depth in range(options.depth):
+        next_level = []
+        for parent in level:
+            for i in range(rng.randint(1,options.fan_out)):
+                d = os.path.join(parent,"d{}-{}".format(depth,i))
+                os.mkdir(d)
+                next_level.append(d)
+        directories += next_level
+        level = next_level
+    return directories
+
+class SyntheticHome:
+    '''The generated directory to back up, at "top"'''
+
+    def __init__(self, top):
+        self.top = top
+        self.files = []
+        self.repositories = []
+        self.next_file = 0
+        self.xattrs_supported = True
+
+    def write_file(self, filename):
+        with open(filename,"wb") as f:
+            f.write(file_contents(file_size()))
+        if self.xattrs_supported and rng.random() < options.xattrs:
+            try:
+                os.setxattr(filename,"user.gib-benchmark",
+                            str(rng.random()).encode())
+            except OSError:
+                print("Extended attributes aren't supported here",
+                      file=sys.stderr)
+                self.xattrs_supported = False
+
+    def add_file(self):
+        directory = rng.choice(self.directories)
+        filename = os.path.join(directory,"f{}.dat".format(self.next_file))
+        self.next_file += 1
+        self.write_file(filename)
+        self.files.append(filename)
+
+    def git_in(self, repository, rest_of_command):
+        check_call(["git","-C",repository] + rest_of_command,
+                   env=environment,stdout=DEVNULL)
+
+    def commit_in_repository(self, repository):
+        filename = os.path.join(repository,"f{}.txt".format(self.next_file))
+        self.next_file += 1
+        self.write_file(filename)
+        self.git_in(repository,["add","."])
+        self.git_in(repository,["commit","-q","-m","Change"])
+
+    def generate(self):
+        self.directories = generate_directories(self.top)
+        for i in range(options.repositories):
+            repository = os.path.join(rng.choice(self.directories),
+                                      "repository{}".format(i))
+            os.mkdir(repository)
+            self.git_in(repository,["init","-q"])
+            self.commit_in_repository(repository)
+            self.repositories.append(repository)
+        for i in range(options.files):
+            self.add_file()
+
+    def churn(self):
+        '''Change about options.churn of the files: most are rewritten,
+        and the rest are removed or added'''
+        changes = max(1,int(options.churn * len(self.files)))
+        for i in range(changes):
+            r = rng.random()
+            if r < 0.8 and self.files:
+                self.write_file(rng.choice(self.files))
+            elif r < 0.9 and self.files:
+                os.remove(self.files.pop(rng.randrange(len(self.files))))
+            else:
+                self.add_file()
+        for repository in self.repositories:
+            self.commit_in_repository(repository)
+
+    def remove_everything(self):
+        for entry in os.scandir(self.top):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+
+def directory_size(path):
+    total = 0
+    for root, directories, files in os.walk(path):
+        for f in files:
+            total += os.lstat(os.path.join(root,f)).st_size
+    return total
+
+def gib_version():
+    '''Return a description of the version of gib being measured'''
+    try:
+        return check_output(
+            ["git","-C",gib_directory,"describe","--always","--dirty"],
+            stderr=DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+work_directory = tempfile.mkdtemp(prefix="gib-benchmark-")
+home = os.path.join(work_directory,"home")
+repository = os.path.join(work_directory,"backup.git")
+log_filename = os.path.join(work_directory,"log")
+environment["HOME"] = work_directory
+environment["XDG_CONFIG_HOME"] = os.path.join(work_directory,"config")
+
+timings = OrderedDict()
+
+def timed(name, command, cwd=None, input=b""):
+    '''Run "command" (with "input" on its standard input), recording
+    how long it took as "name", and exit if it fails'''
+    with open(log_filename,"ab") as log:
+        log.write("\n=== {}: {}\n".format(name,' '.join(command)).encode())
+        log.flush()
+        start_time = time.time()
+        returncode = run(command,cwd=cwd,env=environment,input=input,
+                         stdout=log,stderr=STDOUT).returncode
+        seconds = time.time() - start_time
+    if returncode != 0:
+        print("'{}' failed; see {}".format(name,log_filename),file=sys.stderr)
+        # Keep the files, so that the failure can be investigated:
+        options.keep = True
+        sys.exit(1)
+    timings[name] = round(seconds,3)
+    print("{:<32} {:8.3f}s".format(name,seconds))
+
+def gib(rest_of_command):
+    return [sys.executable,os.path.join(gib_directory,"gib"),
+            "-d",home,"-g",repository] + rest_of_command
+
+def find_in_repository(rest_of_command):
+    return [sys.executable,os.path.join(gib_directory,"find-in-repository.py")] \
+        + rest_of_command
+
+try:
+    os.mkdir(home)
+    os.mkdir(repository)
+    print("Generating {} files in {}".format(options.files,home))
+    synthetic_home = SyntheticHome(home)
+    synthetic_home.generate()
+    total_bytes = directory_size(home)
+
+    timed("init",gib(["init"]))
+    timed("commit (first)",gib(["commit"]))
+    for i in range(options.incremental_commits):
+        synthetic_home.churn()
+        timed("commit (incremental {})".format(i + 1),gib(["commit"]))
+    timed("update-file-list",gib(["update-file-list"]))
+
+    extract_path = os.path.relpath(synthetic_home.directories[1],home) \
+        if len(synthetic_home.directories) > 1 else "."
+    extract_destination = os.path.join(work_directory,"extracted")
+    os.mkdir(extract_destination)
+    timed("extract",gib(["extract",extract_path,extract_destination]))
+
+    synthetic_home.remove_everything()
+    timed("restore",gib(["restore"]),input=b"Yes, I understand.\n")
+
+    timed("find-in-repository --no-index",
+          find_in_repository(["--no-index","-a",r"7\.dat$"]),
+          cwd=repository)
+    timed("index",gib(["index"]))
+    timed("find-in-repository",
+          find_in_repository(["-a",r"7\.dat$"]),
+          cwd=repository)
+finally:
+    if options.keep:
+        print("The files are in {}".format(work_directory))
+    else:
+        shutil.rmtree(work_directory)
+
+parameters = OrderedDict(
+    (name,getattr(options,name))
+    for name in ["files","size","size_distribution","depth","fan_out",
+                 "repositories","xattrs","churn","incremental_commits","seed"]
+)
+
+result = OrderedDict([
+    ("date",time.strftime("%Y-%m-%dT%H:%M:%S%z")),
+    ("version",gib_version()),
+    ("label",options.label),
+    ("host",platform.node()),
+    ("python",platform.python_version()),
+    ("git",check_output(["git","--version"]).decode().strip()),
+    ("parameters",parameters),
+    ("total_bytes",total_bytes),
+    ("timings",timings),
+])
+
+try:
+    with open(options.history) as f:
+        history = json.load(f,object_pairs_hook=OrderedDict)
+except FileNotFoundError:
+    history = []
+
+# Compare with the last run of the same benchmark:
+previous = None
+for r in reversed(history):
+    if r["parameters"] == parameters:
+        previous = r
+        break
+if previous:
+    print("\nCompared with {} ({}):".format(previous["version"],
+                                             previous["date"]))
+    for name, seconds in timings.items():
+        before = previous["timings"].get(name)
+        if before:
+            print("{:<32} {:8.3f}s -> {:8.3f}s ({:+.0f}%)".format(
+                name,before,seconds,100.0*(seconds-before)/before))
+
+history.append(result)
+with open(options.history + ".tmp","w") as f:
+    json.dump(history,f,indent=1)
+os.rename(options.history + ".tmp",options.history)
+print("\nThe results were added to {}".format(options.history))
@@ -0,0 +1,230 @@
+# Very large files (those at least as big as the chunk_threshold set in
+# .gib.conf) are not stored as a single blob.  Instead they are split
+# into chunks at content-defined boundaries, so that when a few bytes
+# are inserted into or removed from a big file, only the chunks around
+# that change are new.  Each chunk is stored as a blob, and the tree
+# contains a small manifest blob at the file's path, of the form:
+#
+#   gib-chunked-file 1
+#   <CHUNK-OBJECT-NAME> <CHUNK-SIZE>
+#   ...
+#
+# The paths that are stored like this are listed (each terminated by a
+# NUL byte) in the file .gib-chunked at the top of the tree, so that
+# "gib show", "gib extract" and "gib restore" know which files to
+# reassemble.
+#
+# Nothing in the tree refers to the chunks directly, so to keep them
+# reachable the chunks added by each commit are also committed to the
+# ref refs/gib-chunks/<BRANCH>.
+#
+# The boundaries are found with a gear hash, as in FastCDC: the hash
+# after each byte is the previous hash shifted left by one plus a
+# random 64-bit value chosen for that byte from a fixed table, so it
+# depends on the last 64 bytes.  A chunk ends wherever the bits of the
+# hash in boundary_mask (spread across the upper bits, which depend on
+# more of those bytes) are all zero.  No boundaries are looked for in
+# the first minimum_chunk_size bytes of a chunk.
+#
+# Within a run of zero bytes the hash soon stops changing, and since
+# that value isn't a boundary, long runs of zeros (as in disk images)
+# are skipped over without computing the hash for each byte.
+
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import zlib
+from subprocess import Popen, PIPE
+
+chunks_ref_prefix = "refs/gib-chunks/"
+chunked_list_filename = ".gib-chunked"
+manifest_magic = b"gib-chunked-file 1\n"
+
+# With these values chunks are usually between one and two MiB:
+minimum_chunk_size = 256 * 1024
+maximum_chunk_size = 4 * 1024 * 1024
+boundary_bits = 20
+
+hash_bits = 64
+hash_limit = (1 << hash_bits) - 1
+
+def random_values(seed, n):
+    '''Return a list of "n" pseudo-random 64-bit integers that are
+    determined by "seed".  These must never change, or every chunk
+    boundary would move.'''
+    return [
+        int.from_bytes(
+            hashlib.sha256(seed + str(i).encode()).digest()[:8],
+            'little'
+        )
+        for i in range(n)
+    ]
+
+def spread_mask(seed, bits):
+    '''Return a mask with "bits" bits set, chosen (as determined by
+    "seed") from the upper three quarters of the hash'''
+    positions = list(range(hash_bits // 4, hash_bits))
+    chosen = set()
+    for value in random_values(seed, 256):
+        if len(chosen) == bits:
+            break
+        chosen.add(positions[value % len(positions)])
+    return sum(1 << position for position in chosen)
+
+gear_table = random_values(b"gib chunking gear table", 256)
+boundary_mask = spread_mask(b"gib chunking boundary mask", boundary_bits)
+
+def gear_hash(h, data):
+    '''Return the hash "h" updated with each byte of "data"'''
+    gear = gear_table
+    for b in data:
+        h = ((h << 1) + gear[b]) & hash_limit
+    return h
+
+# The hash after this many zero bytes no longer changes:
+zero_run = bytes(hash_bits)
+zero_run_hash = gear_hash(0, zero_run)
+assert zero_run_hash & boundary_mask, "a run of zeros must not be a boundary"
+non_zero_byte = re.compile(rb'[^\x00]')
+
+def chunk_end(window):
+    '''Return the length of the chunk at the start of "window" (bytes),
+    which is the first boundary after minimum_chunk_size bytes, or the
+    whole window if there is none'''
+    end = len(window)
+    if end <= minimum_chunk_size:
+        return end
+    gear = gear_table
+    mask = boundary_mask
+    # Start with the hash of the bytes before the first possible
+    # boundary, so that where the boundaries are only depends on the
+    # content:
+    i = minimum_chunk_size
+    h = gear_hash(0, window[i - hash_bits:i])
+    while i < end:
+        run = window.find(zero_run, i, end)
+        stop = end if run < 0 else run + len(zero_run)
+        for b in window[i:stop]:
+            h = ((h << 1) + gear[b]) & hash_limit
+            i += 1
+            if not h & mask:
+                return i
+        if run < 0:
+            break
+        # The hash is now zero_run_hash until the next non-zero byte:
+        m = non_zero_byte.search(window, i, end)
+        i = end if m is None else m.start()
+    return end
+
+def split_into_chunks(f):
+    '''Generate the chunks (bytes) of the file object "f"'''
+    buffer = b''
+    at_end = False
+    while True:
+        if not at_end and len(buffer) < maximum_chunk_size:
+            data = f.read(maximum_chunk_size)
+            if data:
+                buffer += data
+                continue
+            at_end = True
+        if not buffer:
+            return
+        end = chunk_end(buffer[:maximum_chunk_size])
+        yield buffer[:end]
+        buffer = buffer[end:]
+
+class LooseObjectWriter:
+    '''Writes blobs directly to the object database of the repository
+    in "git_directory" as loose objects, unless they already exist.
+    This may be used from several threads at once.'''
+
+    def __init__(self, git_directory):
+        self.objects_directory = os.path.join(git_directory, "objects")
+        self.batch_check = Popen(
+            ["git", "--git-dir=" + git_directory, "cat-file", "--batch-check"],
+            stdin=PIPE,
+            stdout=PIPE
+        )
+        self.lock = threading.Lock()
+
+    def exists(self, object_name):
+        with self.lock:
+            self.batch_check.stdin.write(object_name.encode() + b"\n")
+            self.batch_check.stdin.flush()
+            line = self.batch_check.stdout.readline()
+        return not line.endswith(b" missing\n")
+
+    def write_blob(self, data):
+        '''Store "data" as a blob and return its object name'''
+        header = b"blob " + str(len(data)).encode() + b"\0"
+        h = hashlib.sha1(header)
+        h.update(data)
+        object_name = h.hexdigest()
+        if self.exists(object_name):
+            return object_name
+        directory = os.path.join(self.objects_directory, object_name[:2])
+        os.makedirs(directory, exist_ok=True)
+        compressor = zlib.compressobj(1)
+        fd, temporary_filename = tempfile.mkstemp(dir=directory,
+                                                  prefix="tmp_obj_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(compressor.compress(header))
+                f.write(compressor.compress(data))
+                f.write(compressor.flush())
+            os.chmod(temporary_filename, 0o444)
+            os.replace(temporary_filename,
+                       os.path.join(directory, object_name[2:]))
+        except:
+            os.remove(temporary_filename)
+            raise
+        return object_name
+
+    def close(self):
+        self.batch_check.stdin.close()
+        self.batch_check.wait()
+
+def chunk_file(writer, filename):
+    '''Split the file "filename" into chunks, store them with the
+    LooseObjectWriter "writer", and return a list of (object name, size)
+    tuples for the chunks'''
+    with open(filename, 'rb') as f:
+        return [ (writer.write_blob(chunk), len(chunk))
+                 for chunk in split_into_chunks(f) ]
+
+def make_manifest(chunks):
+    return manifest_magic + b''.join(
+        "{} {}\n".format(object_name, size).encode()
+        for object_name, size in chunks
+    )
+
+def parse_manifest(data):
+    '''Return the list of (object name, size) tuples in the manifest
+    "data", or None if "data" isn't a manifest'''
+    if not data.startswith(manifest_magic):
+        return None
+    chunks = []
+    for line in data[len(manifest_magic):].decode().splitlines():
+        object_name, size = line.split()
+        chunks.append((object_name, int(size)))
+    return chunks
+
+def reassemble(cat_file, manifest_data, f):
+    '''Write the file described by "manifest_data" to the file object
+    "f", reading the chunks with the CatFileBatch "cat_file"'''
+    chunks = parse_manifest(manifest_data)
+    if chunks is None:
+        raise Exception("The manifest of a chunked file was malformed")
+    for object_name, size in chunks:
+        result = cat_file.read_object(object_name)
+        if not result or result[1] != "blob" or len(result[2]) != size:
+            raise Exception("The chunk {} is missing".format(object_name))
+        f.write(result[2])
+
+def parse_chunked_list(data):
+    return set(p for p in data.split(b'\0') if p)
+
+def format_chunked_list(paths):
+    return b''.join(p + b'\0' for p in sorted(paths))
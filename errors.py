@@ -15,3 +15,9 @@ class Errors:
     BAD_TREE = 13
     GIT_DIRECTORY_MISSING = 14
     DIRECTORY_TO_BACKUP_MISSING = 15
+    PATH_INDEX_MISSING = 16
+    GIT_COMMAND_FAILED = 17
+    COMMIT_ALL_FAILED = 18
+    REPLICATION_FAILED = 19
+    NO_SUCH_VERSION = 20
+    RESERVED_BRANCH_NAME = 21
@@ -0,0 +1,364 @@
+# Extracting a tree from the repository without "git archive" and tar.
+# The objects are all read from a single "git cat-file --batch"
+# process, but the files are written by a pool of threads, so that
+# extracting a large tree is limited by the speed of the disk rather
+# than by a single process.  Only blobs smaller than large_blob_size
+# are read into memory and handed to those threads; larger ones are
+# copied from "git cat-file" to the file a megabyte at a time, so the
+# memory used doesn't depend on the size of the files.  The owner,
+# group, permissions, extended attributes and modification time
+# recorded in the .ometastore file are applied to each file as soon as
+# it has been written, and to the directories at the end.  The
+# .ometastore is read alongside the walk of the tree (see
+# MetadataStream), so only the entries for directories are kept in
+# memory.
+#
+# Anything already at the path of a file or directory that is of a
+# different type (e.g. a directory where the tree has a file) is
+# removed first, as "git reset --hard" would.
+#
+# If a Journal is supplied, each file that has been written is recorded
+# in it, so that an interrupted extraction (e.g. "gib restore") can be
+# resumed without writing those files again.
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+from subprocess import Popen, PIPE, DEVNULL
+import threading
+import time
+
+from chunking import reassemble
+from general import mkdir_p
+from githelpers import CatFileBatch
+from metastore import apply_metadata, kind_code, read_metastore
+
+directory_kind = kind_code(0o40000)
+
+large_blob_size = 1024 * 1024
+
+def remove_existing(filename):
+    '''Remove whatever is at "filename", including a whole directory'''
+    if os.path.isdir(filename) and not os.path.islink(filename):
+        shutil.rmtree(filename)
+    elif os.path.lexists(filename):
+        os.remove(filename)
+
+def make_directory(filename):
+    '''Create the directory "filename", unless there is one already,
+    removing any file or symbolic link in the way'''
+    if os.path.islink(filename) or \
+            (os.path.lexists(filename) and not os.path.isdir(filename)):
+        os.remove(filename)
+    os.makedirs(filename, exist_ok=True)
+
+def open_for_writing(filename, mode):
+    '''Return a file object to write a regular file with the tree entry
+    mode "mode" to "filename", replacing anything already there'''
+    remove_existing(filename)
+    permissions = 0o777 if mode & 0o111 else 0o666
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, permissions)
+    return os.fdopen(fd, 'wb')
+
+def write_file(filename, mode, data):
+    '''Write a blob with the tree entry mode "mode" to "filename"'''
+    if mode == 0o120000:
+        remove_existing(filename)
+        os.symlink(data, filename)
+        return
+    with open_for_writing(filename, mode) as f:
+        f.write(data)
+
+def relative_to(path, prefix):
+    '''Return "path" relative to the directory "prefix" (both bytes,
+    with b"" meaning the top of the tree), or None if it's not in that
+    directory'''
+    if not prefix:
+        return path
+    if path == prefix:
+        return b''
+    if path.startswith(prefix + b'/'):
+        return path[len(prefix) + 1:]
+    return None
+
+class MetadataStream:
+    '''The entries of the .ometastore in "ref" for the tree at "prefix",
+    read as they are needed.  The .ometastore is sorted by path, and
+    when a tree is walked in git's order the paths of the files in it
+    come in the same order, so the entry for each file is found by
+    reading on from the previous one.  (Directories are sorted by git
+    as if their names ended in "/", so their entries can come earlier;
+    those are kept in "directories" to be applied at the end.)'''
+
+    def __init__(self, git_command, ref, prefix):
+        self.prefix = prefix
+        self.process = Popen(
+            git_command + ["cat-file", "blob", ref + ":.ometastore"],
+            stdout=PIPE,
+            stderr=DEVNULL
+        )
+        self.entries = read_metastore(self.process.stdout)
+        self.next_entry = None
+        self.directories = {}
+
+    def read(self):
+        '''Return the next entry, or None if there are no more'''
+        if self.next_entry is not None:
+            entry, self.next_entry = self.next_entry, None
+        else:
+            entry = next(self.entries, None)
+        if entry is not None and entry.kind == directory_kind:
+            relative = relative_to(entry.path, self.prefix)
+            if relative is not None:
+                self.directories[relative] = entry
+        return entry
+
+    def lookup(self, path):
+        '''Return the entry for the file "path" (bytes, from the top of
+        the tree), or None if there is none.  Each call must be for a
+        path that comes after the last one in git's order.'''
+        while True:
+            entry = self.read()
+            if entry is None:
+                return None
+            if entry.path == path:
+                return entry
+            if entry.path > path:
+                # This is for a later file, so keep it for next time:
+                self.next_entry = entry
+                return None
+
+    def close(self):
+        '''Read the remaining entries for directories, and return False
+        if there was no .ometastore'''
+        while self.read() is not None:
+            pass
+        self.process.stdout.close()
+        return self.process.wait() == 0
+
+class Journal:
+    '''A record of the files that have been written by an extraction of
+    a particular commit, kept in "filename".  The file starts with the
+    object name of the commit and a newline, followed by the path of
+    each file written, each terminated by a NUL byte.'''
+
+    def __init__(self, filename, commit, done=None):
+        self.filename = filename
+        self.commit = commit
+        self.done = done if done is not None else set()
+        self.lock = threading.Lock()
+        self.f = None
+        self.last_flush = time.time()
+
+    @staticmethod
+    def load(filename):
+        '''Return the Journal in "filename", or None if there is none'''
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        header, _, records = data.partition(b'\n')
+        # The last record may have been cut short, so only keep those
+        # that are terminated:
+        done = set(records.split(b'\0')[:-1])
+        return Journal(filename, header.decode().strip(), done)
+
+    def open(self):
+        mkdir_p(os.path.dirname(self.filename))
+        if os.path.exists(self.filename):
+            self.f = open(self.filename, 'ab')
+        else:
+            self.f = open(self.filename, 'wb')
+            self.f.write(self.commit.encode() + b'\n')
+
+    def record(self, path):
+        with self.lock:
+            self.f.write(path + b'\0')
+            if time.time() - self.last_flush > 1:
+                self.f.flush()
+                self.last_flush = time.time()
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
+
+class Extraction:
+    '''Extracts the tree at "path" (bytes) in "ref" from the repository
+    that "git_command" accesses, to the directory "destination" (bytes),
+    with "jobs" threads writing the files.  "chunked" is the set of paths
+    that are stored in chunks (see chunking.py), "journal" is an
+    optional Journal of the files already written, and "unchanged" is a
+    set of paths whose files are already as they are in "ref", and so
+    aren't written again.'''
+
+    def __init__(self, git_command, ref, path, destination, jobs=1,
+                 chunked=(), journal=None, unchanged=()):
+        self.git_command = git_command
+        self.ref = ref
+        self.prefix = path.strip(b'/')
+        if self.prefix == b'.':
+            self.prefix = b''
+        self.destination = destination
+        self.jobs = jobs
+        self.chunked = chunked
+        self.journal = journal
+        self.unchanged = unchanged
+        self.metadata = None
+        self.files = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.errors = []
+        # Limit the number of blobs waiting to be written:
+        self.pending = threading.BoundedSemaphore(4 * jobs)
+
+    def run(self, report=None, progress_interval=None):
+        '''Extract the files, applying their metadata.  "report", if
+        supplied, is called with a summary at the end, and with the
+        progress so far every "progress_interval" seconds, if that is
+        set.'''
+        self.report = report
+        self.progress_interval = progress_interval
+        self.start_time = self.last_progress = time.time()
+        self.metadata = MetadataStream(self.git_command, self.ref,
+                                       self.prefix)
+        cat_file = CatFileBatch(self.git_command)
+        if self.journal:
+            self.journal.open()
+        try:
+            tree = self.ref + ":" + os.fsdecode(self.prefix)
+            entries = cat_file.read_tree(tree)
+            if entries is None:
+                raise Exception("'{}' is not a tree".format(tree))
+            os.makedirs(self.destination, exist_ok=True)
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                self.extract_tree(cat_file, executor, entries, b'')
+            if not self.metadata.close() and report:
+                report("Warning: there was no .ometastore in " + self.ref)
+        finally:
+            cat_file.close()
+            if self.journal:
+                self.journal.close()
+        if self.errors:
+            raise self.errors[0]
+        self.apply_directory_metadata()
+        if report:
+            report(self.progress_message("Extracted"))
+
+    def progress_message(self, verb):
+        seconds = time.time() - self.start_time
+        megabytes = self.bytes / 1048576.0
+        message = "{} {} files ({:.1f} MiB) in {:.0f}s ({:.1f} MiB/s)".format(
+            verb,
+            self.files,
+            megabytes,
+            seconds,
+            megabytes / max(seconds, 0.001)
+        )
+        if self.skipped:
+            message += ", skipping {} already in place".format(self.skipped)
+        return message
+
+    def extract_tree(self, cat_file, executor, entries, relative_directory):
+        for mode, name, object_name in entries:
+            # Once a writer has failed (e.g. because the disk is full),
+            # stop rather than reading the rest of the tree; run()
+            # raises the error:
+            if self.errors:
+                return
+            relative = relative_directory + b'/' + name \
+                if relative_directory else name
+            filename = os.path.join(self.destination, relative)
+            if mode == 0o40000:
+                make_directory(filename)
+                subtree = cat_file.read_tree(object_name)
+                self.extract_tree(cat_file, executor, subtree, relative)
+                continue
+            elif mode == 0o160000:
+                # Submodules are just empty directories, as with "git
+                # archive":
+                make_directory(filename)
+                continue
+            path = self.prefix + b'/' + relative if self.prefix else relative
+            if path in self.unchanged or \
+                    (self.journal and path in self.journal.done):
+                self.skipped += 1
+                continue
+            metadata = self.metadata.lookup(path)
+            header = cat_file.request(object_name)
+            if header is None:
+                raise Exception("Missing blob {}".format(object_name))
+            size = header[2]
+            if path in self.chunked:
+                self.write_chunked_file(cat_file, filename, mode, path,
+                                        metadata, cat_file.read_contents(size))
+            elif size >= large_blob_size and mode != 0o120000:
+                self.write_large_file(cat_file, filename, mode, path,
+                                      metadata, size)
+            else:
+                data = cat_file.read_contents(size)
+                self.pending.acquire()
+                future = executor.submit(self.write_one, filename, mode,
+                                         path, metadata, data)
+                future.add_done_callback(self.written)
+                self.files += 1
+                self.bytes += size
+            if self.progress_interval and \
+                    time.time() - self.last_progress > self.progress_interval:
+                self.report(self.progress_message("So far, written"))
+                self.last_progress = time.time()
+
+    def write_one(self, filename, mode, path, metadata, data):
+        write_file(filename, mode, data)
+        self.finished_file(filename, path, metadata)
+
+    def finished_file(self, filename, path, metadata):
+        if metadata is not None:
+            apply_metadata(filename, metadata)
+        if self.journal:
+            self.journal.record(path)
+
+    def written(self, future):
+        self.pending.release()
+        if future.exception():
+            self.errors.append(future.exception())
+
+    def write_large_file(self, cat_file, filename, mode, path, metadata,
+                         size):
+        # This is copied straight from "git cat-file" (which has just
+        # been asked for it), rather than being held in memory until a
+        # writer thread is free:
+        with open_for_writing(filename, mode) as f:
+            cat_file.copy_contents(size, f)
+        self.files += 1
+        self.bytes += size
+        self.finished_file(filename, path, metadata)
+
+    def write_chunked_file(self, cat_file, filename, mode, path, metadata,
+                           manifest):
+        # This reads the chunks one at a time, so is done directly
+        # rather than by the writer threads:
+        with open_for_writing(filename, mode) as f:
+            reassemble(cat_file, manifest, f)
+            self.bytes += f.tell()
+        self.files += 1
+        self.finished_file(filename, path, metadata)
+
+    def apply_directory_metadata(self):
+        '''Apply the metadata to the directories, deepest first, so that
+        restrictive permissions or new modification times on them aren't
+        affected by changes to their contents.'''
+        directories = self.metadata.directories
+        for relative in sorted(directories, reverse=True):
+            entry = directories[relative]
+            filename = os.path.join(self.destination, relative) \
+                if relative else self.destination
+            apply_metadata(filename, entry)
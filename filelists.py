@@ -0,0 +1,290 @@
+# The file-lists directory in the git directory contains, for each
+# commit in the repository, a list of the paths in that commit.  The
+# names of these files are of the form YYYY-MM-DD-<COMMIT>.txt, so
+# that you can grep through the lists to find out when a file was
+# backed up.
+#
+# If the git config option gib.fileListFormat is set to "compact",
+# then new lists are stored in one of two compressed forms instead:
+#
+#   YYYY-MM-DD-<COMMIT>.list.gz  - a complete list of the paths
+#
+#   YYYY-MM-DD-<COMMIT>.delta.gz - the paths that were added and
+#                                  removed since the first parent
+#
+# In both of those formats the records are separated by NUL bytes and
+# the paths are not quoted.  The first record of a delta is of the
+# form "parent <COMMIT> <DEPTH>", and each subsequent record is a path
+# prefixed with "+" or "-".  read_file_list() will reconstruct the
+# complete list for a commit from any of these forms.
+
+from contextlib import contextmanager
+import gzip
+import os
+import re
+from subprocess import Popen, PIPE
+
+from chunking import chunks_ref_prefix
+from general import file_iter_bytes_records, mkdir_p
+from githelpers import CatFileBatch, quote_path
+
+tips_leafname = '.tips'
+
+# The commits that just keep the chunks of large files reachable
+# don't need file lists:
+exclude_chunks = '--exclude=' + chunks_ref_prefix + '*'
+
+# The maximum length of a chain of deltas before a complete list is
+# stored again:
+maximum_delta_depth = 64
+
+file_list_re = re.compile(
+    r'^(\d{4}-\d{2}-\d{2})-([0-9a-f]{40})\.(txt|list\.gz|delta\.gz)$'
+)
+
+def existing_lists(directory):
+    '''Return a dictionary mapping each commit that already has a file
+    list in "directory" to the leafname of that list.'''
+    result = {}
+    for leafname in os.listdir(directory):
+        m = file_list_re.match(leafname)
+        if m:
+            result[m.group(2)] = leafname
+    return result
+
+class FileLists:
+    '''The lists of files for each commit in the repository in
+    "git_directory", stored in "directory".'''
+
+    def __init__(self, git_directory, directory, compact=False):
+        self.git_directory = git_directory
+        self.directory = directory
+        self.compact = compact
+        self.cat_file = None
+        # Trees listed for the previous commit, so that unchanged
+        # subtrees don't have to be read again.  This maps the object
+        # name of each tree to a tuple of the paths in that tree and
+        # the object names of its immediate subtrees:
+        self.tree_cache = {}
+        # The most recently listed commits' paths, for making deltas:
+        self.recent_lists = {}
+
+    def git(self, rest_of_command):
+        return ["git", "--git-dir=" + self.git_directory] + rest_of_command
+
+    def read_tips(self):
+        try:
+            with open(os.path.join(self.directory, tips_leafname)) as f:
+                return f.read().split()
+        except FileNotFoundError:
+            return []
+
+    def write_tips(self, tips):
+        filename = os.path.join(self.directory, tips_leafname)
+        with open(filename + '.tmp', 'w') as f:
+            f.write(''.join(t + '\n' for t in tips))
+        os.rename(filename + '.tmp', filename)
+
+    def current_tips(self):
+        p = Popen(self.git(["rev-parse", exclude_chunks, "--all"]), stdout=PIPE)
+        output = p.communicate()[0]
+        if p.returncode != 0:
+            raise Exception("Finding the tips of all refs failed")
+        return sorted(set(output.decode().split()))
+
+    def missing_commits(self, tips):
+        '''Generate a (commit, date) tuple for every commit that isn't
+        in the history of "tips", parents before children.  If that
+        fails (e.g. because one of the tips no longer exists) then
+        generate every commit instead.'''
+        for exclude in (tips, []):
+            command = self.git([
+                "log", exclude_chunks, "--all", "--topo-order", "--reverse",
+                "--format=%H %ad", "--date=short", "--stdin"
+            ])
+            p = Popen(command, stdin=PIPE, stdout=PIPE)
+            p.stdin.write(''.join('^' + t + '\n' for t in exclude).encode())
+            p.stdin.close()
+            output = p.stdout.read()
+            if p.wait() == 0:
+                for line in output.decode().splitlines():
+                    commit, date = line.split()
+                    yield commit, date
+                return
+        raise Exception("Finding the commits in the repository failed")
+
+    def update(self, progress=None):
+        '''Create file lists for every commit that doesn't have one.
+        "progress", if supplied, is called with the leafname of each
+        list that is created.'''
+        mkdir_p(self.directory)
+        tips = self.current_tips()
+        existing = existing_lists(self.directory)
+        self.cat_file = CatFileBatch(self.git([]))
+        try:
+            for commit, date in self.missing_commits(self.read_tips()):
+                if commit in existing:
+                    continue
+                leafname = self.write_list(commit, date, existing)
+                existing[commit] = leafname
+                if progress:
+                    progress(leafname)
+        finally:
+            self.cat_file.close()
+            self.cat_file = None
+        self.write_tips(tips)
+
+    def list_tree(self, tree, new_cache):
+        '''Return a list of the paths (bytes) under the tree with object
+        name "tree", in the order that "git ls-tree -r" would give.'''
+        if tree in self.tree_cache:
+            self.keep_cached_tree(tree, new_cache)
+            return self.tree_cache[tree][0]
+        paths = []
+        subtrees = []
+        for mode, name, object_name in self.cat_file.read_tree(tree):
+            if mode == 0o40000:
+                subtrees.append(object_name)
+                prefix = name + b'/'
+                for path in self.list_tree(object_name, new_cache):
+                    paths.append(prefix + path)
+            else:
+                paths.append(name)
+        new_cache[tree] = (paths, subtrees)
+        return paths
+
+    def keep_cached_tree(self, tree, new_cache):
+        if tree not in new_cache:
+            new_cache[tree] = self.tree_cache[tree]
+            for subtree in self.tree_cache[tree][1]:
+                self.keep_cached_tree(subtree, new_cache)
+
+    def list_commit(self, commit):
+        tree = self.cat_file.read_object(commit + "^{tree}")
+        if not tree:
+            raise Exception("Finding files in commit {} failed".format(commit))
+        new_cache = {}
+        result = self.list_tree(tree[0], new_cache)
+        self.tree_cache = new_cache
+        return result
+
+    def write_list(self, commit, date, existing):
+        paths = self.list_commit(commit)
+        prefix = os.path.join(self.directory, date + '-' + commit)
+        if not self.compact:
+            leafname = date + '-' + commit + '.txt'
+            with atomic_open(prefix + '.txt') as f:
+                for path in paths:
+                    f.write(quote_path(path) + b'\n')
+        else:
+            delta = self.delta_from_parent(commit, paths, existing)
+            if delta is None:
+                leafname = date + '-' + commit + '.list.gz'
+                with atomic_open(prefix + '.list.gz', compressed=True) as f:
+                    for path in paths:
+                        f.write(path + b'\0')
+            else:
+                leafname = date + '-' + commit + '.delta.gz'
+                with atomic_open(prefix + '.delta.gz', compressed=True) as f:
+                    for record in delta:
+                        f.write(record + b'\0')
+        self.recent_lists[commit] = paths
+        while len(self.recent_lists) > 4:
+            del self.recent_lists[next(iter(self.recent_lists))]
+        return leafname
+
+    def delta_from_parent(self, commit, paths, existing):
+        '''Return the records of a delta between the first parent's
+        list and "paths", or None if a complete list should be stored'''
+        parents = self.cat_file.read_object(commit)[2].split(b'\n\n')[0]
+        parent = None
+        for line in parents.split(b'\n'):
+            if line.startswith(b'parent '):
+                parent = line[7:].decode()
+                break
+        if parent is None or parent not in existing:
+            return None
+        depth = delta_depth(self.directory, existing[parent]) + 1
+        if depth > maximum_delta_depth:
+            return None
+        if parent in self.recent_lists:
+            parent_paths = self.recent_lists[parent]
+        else:
+            parent_paths = read_file_list(self.directory, parent, existing)
+        old = set(parent_paths)
+        new = set(paths)
+        header = 'parent {} {}'.format(parent, depth).encode()
+        return [header] + \
+            [b'-' + p for p in sorted(old - new)] + \
+            [b'+' + p for p in sorted(new - old)]
+
+@contextmanager
+def atomic_open(filename, compressed=False):
+    '''Open "filename" for writing in binary mode, such that the file
+    only appears under that name once it has been completely written'''
+    temporary_filename = filename + '.tmp'
+    if compressed:
+        f = gzip.open(temporary_filename, 'wb')
+    else:
+        f = open(temporary_filename, 'wb')
+    try:
+        with f:
+            yield f
+    except:
+        os.remove(temporary_filename)
+        raise
+    os.rename(temporary_filename, filename)
+
+def read_records(filename):
+    with gzip.open(filename, 'rb') as f:
+        for record in file_iter_bytes_records(f, b'\0', b''):
+            yield record
+
+def delta_depth(directory, leafname):
+    if not leafname.endswith('.delta.gz'):
+        return 0
+    header = next(read_records(os.path.join(directory, leafname)))
+    return int(header.split()[2])
+
+def read_file_list(directory, commit, existing=None):
+    '''Return a list of the paths (bytes, unquoted) in the file list
+    for "commit", reconstructing it from deltas if necessary.  Returns
+    None if there is no list for that commit.'''
+    if existing is None:
+        existing = existing_lists(directory)
+    if commit not in existing:
+        return None
+    leafname = existing[commit]
+    filename = os.path.join(directory, leafname)
+    if leafname.endswith('.txt'):
+        with open(filename, 'rb') as f:
+            return [ unquote_path(line) for line in f.read().splitlines() ]
+    elif leafname.endswith('.list.gz'):
+        return list(read_records(filename))
+    records = read_records(filename)
+    parent = next(records).split()[1].decode()
+    paths = set(read_file_list(directory, parent, existing))
+    for record in records:
+        if record.startswith(b'-'):
+            paths.discard(record[1:])
+        else:
+            paths.add(record[1:])
+    # Sorting the complete paths bytewise gives the same order as
+    # "git ls-tree -r":
+    return sorted(paths)
+
+c_style_unescapes = {
+    b'a': b'\a', b'b': b'\b', b't': b'\t', b'n': b'\n',
+    b'v': b'\v', b'f': b'\f', b'r': b'\r', b'"': b'"', b'\\': b'\\'
+}
+
+def unquote_path(quoted):
+    '''Reverse the quoting done by githelpers.quote_path'''
+    if not quoted.startswith(b'"'):
+        return quoted
+    return re.sub(
+        rb'\\([0-7]{3}|.)',
+        lambda m: bytes([int(m.group(1), 8)]) if len(m.group(1)) == 3
+                  else c_style_unescapes[m.group(1)],
+        quoted[1:-1]
+    )
@@ -1,26 +1,31 @@
 #!/usr/bin/env python3
 
+from multiprocessing import get_context
 from optparse import OptionParser
 import os
 import re
-from subprocess import Popen, PIPE
 import sys
 
+from chunking import chunks_ref_prefix
+from githelpers import CatFileBatch, parse_tree, tree_mode_to_type
+from pathindex import PathIndex
+from plumbing import GitCommandFailed, lines
+
 # A small script for finding files in a git repository.  This is
 # mostly useful for inding files that you know appeared in the history
 # of some branch at some point, but can't remember where...
+#
+# If the repository has an index of paths (as created by "gib index")
+# then the refs that are branches are searched using that index, which
+# is much faster.  In that case, with --all-history each version of a
+# file is only reported once, with the last commit it was seen in.
 
-def command_to_lines(command,nul=False):
-    p = Popen(command,stdout=PIPE)
-    output = p.communicate()[0]
-    if p.returncode != 0:
-        print("'{}' failed.".format(' '.join(command),file=sys.stderr))
+def command_to_lines(command):
+    try:
+        return list(lines(command))
+    except GitCommandFailed as e:
+        print(e,file=sys.stderr)
         sys.exit(1)
-    str_output = output.decode()
-    if nul:
-        return str_output.split('\0')
-    else:
-        return str_output.splitlines(False)
 
 parser = OptionParser(usage="Usage: %prog [OPTIONS] PATH-REGEXP")
 parser.add_option('--start-ref',
@@ -38,6 +43,16 @@ parser.add_option('--all-history','-a',
                   dest="all_history",
                   default=False,
                   help="when starting from refs, look through their complete history")
+parser.add_option('--no-index',
+                  action="store_false",
+                  dest="use_index",
+                  default=True,
+                  help="don't use the index of paths, even if there is one")
+parser.add_option('--jobs','-j',
+                  dest="jobs",
+                  type="int",
+                  default=os.cpu_count(),
+                  help="the number of processes to read trees with")
 
 options,args = parser.parse_args()
 
@@ -58,53 +73,119 @@ if options.start_tree and options.all_history:
     sys.exit(1)
 
 if options.start_ref:
-    for line in command_to_lines(['git','rev-parse',options.start_ref]):
-        m = re.search('(\S+)',line)
-        if m:
-            object_name = m.group(1)
+    for object_name in command_to_lines(['git','rev-parse',options.start_ref]):
+        if object_name:
             all_refs.setdefault(object_name,[])
             all_refs[object_name].append(options.start_ref)
 else:
-    for line in command_to_lines(["git","for-each-ref"]):
-        m = re.search('(\S+)\s+\S+\s+(\S+)',line)
-        if m:
-            object_name = m.group(1)
+    for line in command_to_lines(
+            ["git","for-each-ref","--format=%(objectname) %(refname)"]):
+        object_name, _, ref = line.partition(' ')
+        # Skip the refs that just keep the chunks of large files
+        # reachable:
+        if ref and not ref.startswith(chunks_ref_prefix):
             all_refs.setdefault(object_name,[])
-            all_refs[object_name].append(m.group(2))
+            all_refs[object_name].append(ref)
+
+def search_index(path_index,branch=None):
+    '''Answer the query from the index of paths, optionally restricted
+    to "branch"'''
+    path_index.update()
+    sys.stdout.flush()
+    for row in path_index.search(path_regexp,branch,options.all_history):
+        branch, path, object_name, mode, first_commit, last_commit = row
+        refs = []
+        if heads.get(branch) == last_commit:
+            refs = all_refs.get(last_commit,[])
+        prefix = "{} ({})".format(last_commit,','.join(refs))
+        line = "{} {} ".format(prefix,object_name).encode() + path + b"\n"
+        sys.stdout.buffer.write(line)
+
+path_index = None
+if options.use_index and not options.start_tree:
+    git_directory = command_to_lines(["git","rev-parse","--absolute-git-dir"])[0]
+    path_index = PathIndex(git_directory)
+    if path_index.exists():
+        heads = path_index.branch_heads()
+    else:
+        path_index = None
+
+if path_index and options.start_ref:
+    full_name = command_to_lines(
+        ["git","rev-parse","--symbolic-full-name",options.start_ref]
+    )
+    if full_name and full_name[0].startswith("refs/heads/"):
+        search_index(path_index,full_name[0][len("refs/heads/"):])
+        sys.exit(0)
+elif path_index:
+    search_index(path_index)
+    # Any refs that are not branches are not in the index, so still
+    # search those below:
+    for object_name in list(all_refs.keys()):
+        all_refs[object_name] = [ r for r in all_refs[object_name]
+                                  if not r.startswith("refs/heads/") ]
+        if not all_refs[object_name]:
+            del all_refs[object_name]
 
-# Cache all already explored trees:
+# Each worker process keeps its own "git cat-file --batch" process
+# and a cache of all the trees it has already explored:
+cat_file = None
+compiled_path_re = None
 trees_dictionary = {}
 
+def start_worker(regexp):
+    global cat_file, compiled_path_re
+    cat_file = CatFileBatch()
+    compiled_path_re = re.compile(regexp)
+
 def tree_to_recursive_list(tree):
     if tree in trees_dictionary:
         return trees_dictionary[tree]
+    result = cat_file.read_object(tree)
+    if not result or result[1] != "tree":
+        raise Exception("'{}' was not a tree".format(tree))
+    tree_object_name, object_type, data = result
+    if tree_object_name in trees_dictionary:
+        return trees_dictionary[tree_object_name]
     files = []
-    for line in command_to_lines(["git","ls-tree","-z",tree],nul=True):
-        m = re.search('(\S+)\s+(\S+)\s+(\S+)\s+(.*)',line)
-        if m:
-            mode, object_type, object_name, entry_name = m.groups()
-            mode_int = int(mode,8) % 0o1000
-            if object_type == "tree":
-                files_in_tree = tree_to_recursive_list(object_name)
-                for t in files_in_tree:
-                    files.append((t[0],os.path.join(entry_name,t[1]),t[2]))
-            elif object_type == "blob":
-                files.append((object_name,entry_name,mode_int))
-    trees_dictionary.setdefault(tree,files)
+    for mode, entry_name, object_name in parse_tree(data):
+        object_type = tree_mode_to_type(mode)
+        if object_type == "tree":
+            files_in_tree = tree_to_recursive_list(object_name)
+            for t in files_in_tree:
+                files.append((t[0],entry_name+b'/'+t[1],t[2]))
+        elif object_type == "blob":
+            files.append((object_name,entry_name,mode % 0o1000))
+    trees_dictionary.setdefault(tree_object_name,files)
     return files
 
-def deal_with_tree(tree,prefix,d='.'):
-    for t in tree_to_recursive_list(tree):
-        if re.search(path_regexp,t[1]):
-            print("{} {} {}".format(prefix,t[0],t[1]))
+def deal_with_tree(job):
+    tree, prefix = job
+    output = []
+    for t in tree_to_recursive_list(tree+"^{tree}"):
+        if compiled_path_re.search(os.fsdecode(t[1])):
+            output.append("{} {} ".format(prefix,t[0]).encode()+t[1]+b"\n")
+    return b"".join(output)
 
-if options.start_tree:
-    deal_with_tree(options.start_tree,'None ()')
-else:
-    for r in all_refs:
-        prefix = "{} ({})".format(r,','.join(all_refs[r]))
-        deal_with_tree(r,prefix,r)
-        if options.all_history:
-            for commit in command_to_lines(["git","log","--format=%H",r])[1:]:
-                prefix = commit+" ()"
-                deal_with_tree(commit,prefix,commit)
+def jobs():
+    if options.start_tree:
+        yield (options.start_tree,'None ()')
+    else:
+        for r in all_refs:
+            prefix = "{} ({})".format(r,','.join(all_refs[r]))
+            yield (r,prefix)
+            if options.all_history:
+                history = lines(["git","log","--skip=1","--format=%H",r])
+                for commit in history:
+                    yield (commit,commit+" ()")
+
+sys.stdout.flush()
+# Adjacent commits usually share most of their trees, so hand them to
+# the workers in chunks to make the best use of each worker's cache:
+with get_context("fork").Pool(options.jobs,start_worker,(path_regexp,)) as pool:
+    try:
+        for output in pool.imap(deal_with_tree,jobs(),chunksize=16):
+            sys.stdout.buffer.write(output)
+    except Exception as e:
+        print(e,file=sys.stderr)
+        sys.exit(1)
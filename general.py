@@ -4,6 +4,7 @@
 from contextlib import contextmanager
 import datetime
 import errno
+import fcntl
 import os
 from os.path import realpath
 import pwd
@@ -101,7 +102,7 @@ def ensure_trailing_slash(path):
 def file_iter_bytes_records(input_file,
                             separator=b'\n',
                             output_separator=None,
-                            read_size=8192):
+                            read_size=65536):
    '''Like the normal file iter but you can set what string indicates
    newline.
 
@@ -110,21 +111,42 @@ def file_iter_bytes_records(input_file,
    and control whether or not the newline string is left on the end of
    the iterated lines.  Setting newline to b'\0' is particularly good
    for use with an input file created with something like
-   "os.popen('find -print0')".'''
+   "os.popen('find -print0')".
+
+   The input is read as a stream (with read1, if the file has it, so
+   that records are generated as soon as they arrive from a pipe) into
+   a single buffer, and each record is copied out of that buffer once,
+   so memory use only depends on the size of the longest record.'''
    if output_separator is None:
        output_separator = separator
-   partial_line = bytes()
+   read = getattr(input_file, 'read1', input_file.read)
+   separator_length = len(separator)
+   buffer = bytearray()
    while True:
-       just_read = input_file.read(read_size)
+       just_read = read(read_size)
        if not just_read:
            break
-       partial_line += just_read
-       lines = partial_line.split(separator)
-       partial_line = lines.pop()
-       for line in lines:
-           yield line + output_separator
-   if partial_line:
-       yield partial_line
+       # A separator may span the end of the previous read:
+       search_from = max(0, len(buffer) - separator_length + 1)
+       buffer += just_read
+       end = buffer.find(separator, search_from)
+       if end < 0:
+           continue
+       start = 0
+       view = memoryview(buffer)
+       try:
+           while end >= 0:
+               if output_separator:
+                   yield bytes(view[start:end]) + output_separator
+               else:
+                   yield bytes(view[start:end])
+               start = end + separator_length
+               end = buffer.find(separator, start)
+       finally:
+           view.release()
+       del buffer[:start]
+   if buffer:
+       yield bytes(buffer)
 
 @contextmanager
 def cd(path):
@@ -134,3 +156,24 @@ def cd(path):
         yield
     finally:
         os.chdir(old_dir)
+
+@contextmanager
+def lock_file(path):
+    '''Hold an exclusive lock on the file "path" (which is created if
+    necessary) until the end of the with statement, waiting for any
+    other process that holds the lock to release it'''
+    fd = os.open(path,os.O_RDWR|os.O_CREAT,0o600)
+    try:
+        fcntl.flock(fd,fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+def parse_size(s):
+    '''Parse a size such as "512K", "100M" or "2G" into a number of
+    bytes'''
+    s = s.strip().upper()
+    multipliers = { 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3 }
+    if s and s[-1] in multipliers:
+        return int(s[:-1]) * multipliers[s[-1]]
+    return int(s)
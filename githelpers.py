@@ -1,4 +1,8 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import heapq
 import os
+from subprocess import Popen, PIPE
 
 from general import exists_and_is_directory
 
@@ -12,9 +16,27 @@ def has_objects_and_refs(path):
     return exists_and_is_directory(objects_path) and \
         exists_and_is_directory(refs_path)
 
-def probable_non_bare_repository(path):
+def nested_git_directory(path):
+    '''Return the git directory of the working tree at "path": either
+    <path>/.git, or, if that is a gitfile (as "git submodule update"
+    leaves), the directory that it refers to.  Returns None if there is
+    no git directory.'''
     git_directory_path = os.path.join(path,'.git')
-    return has_objects_and_refs(git_directory_path)
+    if os.path.isdir(git_directory_path):
+        return git_directory_path
+    if not os.path.isfile(git_directory_path):
+        return None
+    p = Popen(["git","-C",path,"rev-parse","--absolute-git-dir"],
+              stdout=PIPE)
+    output = p.communicate()[0]
+    if p.returncode != 0:
+        return None
+    return output.decode().rstrip('\n')
+
+def probable_non_bare_repository(path):
+    git_directory_path = nested_git_directory(path)
+    return git_directory_path is not None and \
+        has_objects_and_refs(git_directory_path)
 
 def is_in_another_git_repository(relative_path):
     if not exists_and_is_directory(relative_path):
@@ -26,3 +48,340 @@ def is_in_another_git_repository(relative_path):
         if probable_non_bare_repository(parent):
             return True
         relative_path = parent
+
+def parse_tree(data):
+    '''Generate a (mode, name, object_name) tuple for each entry in the
+    raw contents of a tree object, "data".  "mode" is an integer,
+    "name" is bytes and "object_name" is a hex string.'''
+    position = 0
+    length = len(data)
+    while position < length:
+        space = data.index(b' ', position)
+        nul = data.index(b'\0', space)
+        mode = int(data[position:space], 8)
+        name = data[space+1:nul]
+        object_name = data[nul+1:nul+21].hex()
+        position = nul + 21
+        yield (mode, name, object_name)
+
+def tree_mode_to_type(mode):
+    '''Return the type of object that a tree entry with "mode" refers to'''
+    if mode == 0o40000:
+        return "tree"
+    elif mode == 0o160000:
+        return "commit"
+    else:
+        return "blob"
+
+class CatFileBatch:
+    '''A wrapper around a single long-lived "git cat-file --batch"
+    process, so that many objects can be read without starting a new
+    process for each one.'''
+
+    def __init__(self, git_command=["git"]):
+        self.process = Popen(
+            git_command + ["cat-file","--batch"],
+            stdin=PIPE,
+            stdout=PIPE,
+            # Reading large blobs is much quicker with a bigger buffer
+            # than the default:
+            bufsize=65536
+        )
+
+    def request(self, name):
+        '''Ask for the object "name" (as for read_object) and return
+        (object_name, object_type, size), or None if it does not exist.
+        Its contents must then be read with read_contents or
+        copy_contents before anything else is asked for.'''
+        self.process.stdin.write(os.fsencode(name) + b'\n')
+        self.process.stdin.flush()
+        header = self.process.stdout.readline()
+        if not header:
+            raise Exception("git cat-file exited unexpectedly")
+        if header.endswith((b' missing\n', b' ambiguous\n')):
+            return None
+        object_name, object_type, size = header.split()
+        return (object_name.decode(), object_type.decode(), int(size))
+
+    def read_contents(self, size):
+        data = self.process.stdout.read(size)
+        # Each object is followed by a newline:
+        self.process.stdout.read(1)
+        return data
+
+    def copy_contents(self, size, f, buffer_size=1048576):
+        '''Write the "size" bytes of the object just requested to the
+        file object "f", "buffer_size" bytes at a time, so that large
+        objects are never held in memory'''
+        remaining = size
+        while remaining > 0:
+            data = self.process.stdout.read(min(remaining, buffer_size))
+            if not data:
+                raise Exception("git cat-file exited unexpectedly")
+            f.write(data)
+            remaining -= len(data)
+        self.process.stdout.read(1)
+
+    def read_object(self, name):
+        '''Return (object_name, object_type, data) for the object
+        "name", which may be any expression that "git cat-file"
+        understands, e.g. "HEAD:README" or "master^{tree}", as a
+        string or bytes.  If the object does not exist, return None.'''
+        header = self.request(name)
+        if header is None:
+            return None
+        object_name, object_type, size = header
+        return (object_name, object_type, self.read_contents(size))
+
+    def read_tree(self, name):
+        '''Return a list of the (mode, name, object_name) entries in the
+        tree that "name" refers to, or None if that isn't a tree.'''
+        result = self.read_object(name)
+        if not result or result[1] != "tree":
+            return None
+        return list(parse_tree(result[2]))
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+class CatFileBatchCheck:
+    '''Like CatFileBatch, but for a "git cat-file --batch-check" process,
+    for finding the type and size of objects without reading them.'''
+
+    def __init__(self, git_command=["git"]):
+        self.process = Popen(
+            git_command + ["cat-file","--batch-check"],
+            stdin=PIPE,
+            stdout=PIPE
+        )
+
+    def object_info(self, name):
+        '''Return (object_name, object_type, size) for the object
+        "name", as for CatFileBatch.read_object, or None if it does not
+        exist.'''
+        self.process.stdin.write(os.fsencode(name) + b'\n')
+        self.process.stdin.flush()
+        header = self.process.stdout.readline()
+        if not header:
+            raise Exception("git cat-file exited unexpectedly")
+        if header.endswith((b' missing\n', b' ambiguous\n')):
+            return None
+        object_name, object_type, size = header.split()
+        return (object_name.decode(), object_type.decode(), int(size))
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+class PathLookup:
+    '''Finds the objects at paths in commits, reading the trees with the
+    CatFileBatch "cat_file".  The trees are cached, so that looking up
+    many paths in the same commit (or in commits that share subtrees)
+    only reads each tree once.  At most "maximum_trees" are kept.'''
+
+    def __init__(self, cat_file, maximum_trees=10000):
+        self.cat_file = cat_file
+        self.maximum_trees = maximum_trees
+        self.root_trees = {}
+        self.trees = {}
+
+    def root_tree(self, ref):
+        '''Return the object name of the tree of the commit "ref", or
+        None if there is no such commit'''
+        if ref not in self.root_trees:
+            result = self.cat_file.read_object(ref + "^{tree}")
+            self.root_trees[ref] = result[0] if result else None
+        return self.root_trees[ref]
+
+    def entries(self, tree):
+        '''Return a dictionary mapping each name in "tree" to a tuple
+        of (mode, object name)'''
+        if tree not in self.trees:
+            if len(self.trees) >= self.maximum_trees:
+                self.trees.clear()
+            self.trees[tree] = dict(
+                (name, (mode, object_name))
+                for mode, name, object_name in self.cat_file.read_tree(tree)
+            )
+        return self.trees[tree]
+
+    def lookup(self, ref, path):
+        '''Return a tuple of (mode, object name) for "path" (bytes) in
+        "ref", or None if there is no such path'''
+        tree = self.root_tree(ref)
+        if tree is None:
+            return None
+        components = [ c for c in path.split(b'/') if c ]
+        if not components:
+            return None
+        for i, component in enumerate(components):
+            entry = self.entries(tree).get(component)
+            if entry is None:
+                return None
+            if i == len(components) - 1:
+                return entry
+            mode, tree = entry
+            if mode != 0o40000:
+                return None
+
+c_style_escapes = {
+    0x07: b'\\a', 0x08: b'\\b', 0x09: b'\\t', 0x0a: b'\\n',
+    0x0b: b'\\v', 0x0c: b'\\f', 0x0d: b'\\r',
+    0x22: b'\\"', 0x5c: b'\\\\'
+}
+
+def quote_path(path):
+    '''Quote the path "path" (bytes) in the same way as git does in
+    its output when "-z" isn't used and core.quotePath is true'''
+    if not any(c < 0x20 or c >= 0x7f or c in (0x22, 0x5c) for c in path):
+        return path
+    quoted = bytearray(b'"')
+    for c in path:
+        if c in c_style_escapes:
+            quoted += c_style_escapes[c]
+        elif c < 0x20 or c >= 0x7f:
+            quoted += '\\{:03o}'.format(c).encode()
+        else:
+            quoted.append(c)
+    quoted += b'"'
+    return bytes(quoted)
+
+def repository_fingerprint(git_directory):
+    '''Return a string that will change whenever the refs or objects in
+    the repository "git_directory" change.  This is computed from HEAD,
+    packed-refs, the loose refs, the config and the names and sizes of
+    the pack files and loose objects, without reading any objects.'''
+    h = hashlib.sha1()
+    def add_stat(path):
+        try:
+            s = os.stat(path)
+            h.update("{} {} {}\n".format(path,s.st_size,s.st_mtime_ns).encode())
+        except FileNotFoundError:
+            h.update("{} missing\n".format(path).encode())
+    def add_contents(path):
+        try:
+            with open(path,'rb') as f:
+                h.update(path.encode() + b'\0' + f.read() + b'\0')
+        except FileNotFoundError:
+            h.update("{} missing\n".format(path).encode())
+    add_contents(os.path.join(git_directory,'HEAD'))
+    add_contents(os.path.join(git_directory,'packed-refs'))
+    add_stat(os.path.join(git_directory,'config'))
+    for root, directories, files in os.walk(os.path.join(git_directory,'refs')):
+        directories.sort()
+        for f in sorted(files):
+            add_contents(os.path.join(root,f))
+    objects_directory = os.path.join(git_directory,'objects')
+    try:
+        for leafname in sorted(os.listdir(objects_directory)):
+            path = os.path.join(objects_directory,leafname)
+            if leafname == 'pack':
+                for pack_leafname in sorted(os.listdir(path)):
+                    add_stat(os.path.join(path,pack_leafname))
+            elif len(leafname) == 2:
+                h.update(leafname.encode() + b'/')
+                h.update(b' '.join(n.encode() for n in sorted(os.listdir(path))))
+    except FileNotFoundError:
+        pass
+    return h.hexdigest()
+
+def update_index_records(git_command, options, records, batch_size=10000):
+    '''Run "git update-index" with the list "options", writing the
+    input for each (path, record) tuple in "records" to its standard
+    input, in batches.  If a batch fails, it is split up to find the
+    records that couldn't be processed.  Returns a list of their
+    paths.'''
+    failed = []
+    batches = [ records[i:i+batch_size]
+                for i in range(0, len(records), batch_size) ]
+    while batches:
+        batch = batches.pop(0)
+        p = Popen(git_command + ["update-index"] + options, stdin=PIPE)
+        p.communicate(b''.join(record for path, record in batch))
+        if p.returncode == 0:
+            continue
+        if len(batch) == 1:
+            failed.append(batch[0][0])
+        else:
+            middle = len(batch) // 2
+            batches[0:0] = [batch[:middle], batch[middle:]]
+    return failed
+
+def update_index(git_command, options, paths, batch_size=10000):
+    '''Run "git update-index -z --stdin" with the list "options" for
+    "paths" (bytes), in batches.  Returns a list of the paths that
+    couldn't be processed.'''
+    return update_index_records(
+        git_command,
+        options + ["-z","--stdin"],
+        [ (path, path + b'\0') for path in paths ],
+        batch_size
+    )
+
+def stage_objects(git_command, entries, batch_size=10000):
+    '''Stage each of the (mode, object_name, path) tuples in "entries"
+    with "git update-index --index-info", without reading the files.
+    Returns a list of the paths that couldn't be staged.'''
+    return update_index_records(
+        git_command,
+        ["--replace","-z","--index-info"],
+        [ (path, "{:o} {}\t".format(mode, object_name).encode() + path + b'\0')
+          for mode, object_name, path in entries ],
+        batch_size
+    )
+
+def refresh_index(git_command, paths):
+    '''Record the current stat information in the index for "paths"
+    (bytes), which "git update-index --index-info" leaves as zeroes, so
+    that later git commands don't have to read those files again to
+    see that they're unchanged.  Returns True if that succeeded.'''
+    p = Popen(git_command + ["--literal-pathspecs","add","--refresh",
+                             "--pathspec-from-file=-","--pathspec-file-nul"],
+              stdin=PIPE)
+    p.communicate(b''.join(path + b'\0' for path in paths))
+    return p.returncode == 0
+
+def hash_objects(git_command, paths_and_sizes, jobs):
+    '''Write a blob to the object database for each of the files in
+    "paths_and_sizes", a list of (path, size) tuples, using "jobs"
+    "git hash-object -w --stdin-paths" processes at once.  The files are
+    shared out so that each process has about the same number of bytes
+    to compress, largest files first.  Returns a tuple of a dictionary
+    mapping each path that was hashed to its object name, and a list of
+    the paths that couldn't be hashed (e.g. because they have been
+    removed).'''
+    slices = [ (0, i, []) for i in range(jobs) ]
+    for path, size in sorted(paths_and_sizes, key=lambda t: -t[1]):
+        total, i, paths = heapq.heappop(slices)
+        paths.append(path)
+        heapq.heappush(slices, (total + size, i, paths))
+
+    def hash_slice(paths):
+        object_names = {}
+        failed = []
+        while paths:
+            p = Popen(git_command + ["hash-object","-w","--stdin-paths"],
+                      stdin=PIPE, stdout=PIPE)
+            # Paths are separated by newlines, so quote any unusual ones:
+            output = p.communicate(
+                b''.join(quote_path(path) + b'\n' for path in paths)
+            )[0].split()
+            for path, object_name in zip(paths, output):
+                object_names[path] = object_name.decode()
+            if p.returncode == 0 or len(output) >= len(paths):
+                break
+            # hash-object stops at the first file that it can't read,
+            # so carry on after that one:
+            failed.append(paths[len(output)])
+            paths = paths[len(output) + 1:]
+        return object_names, failed
+
+    object_names = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for names, slice_failed in executor.map(
+                hash_slice, [ s[2] for s in slices if s[2] ]):
+            object_names.update(names)
+            failed += slice_failed
+    return object_names, failed
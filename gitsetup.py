@@ -1,14 +1,18 @@
 from configparser import RawConfigParser
+from contextlib import contextmanager
 import os
 import re
-from subprocess import call, check_call, Popen, PIPE, STDOUT
+import shutil
+from subprocess import call, check_call, check_output, Popen, PIPE, STDOUT
 import sys
 
 from errors import Errors
 from general import (
-    exists_and_is_directory, shellquote, print_stderr
+    exists_and_is_directory, lock_file, mkdir_p, parse_size, shellquote,
+    print_stderr
 )
 from githelpers import has_objects_and_refs
+from repositorystore import store_leafname
 
 class OptionFrom:
     '''enum-like values to indicate the source of different options, used in
@@ -21,7 +25,7 @@ class OptionFrom:
                         DEFAULT_VALUE : "default value" }
 
 class GibSetup:
-    def __init__(self, command_line_options):
+    def __init__(self, command_line_options, git_directory_must_exist=True):
 
         self.configuration_file = '.gib.conf'
 
@@ -34,6 +38,8 @@ class GibSetup:
         self.branch = None
         self.branch_from = None
 
+        self.lock_depth = 0
+
         if command_line_options.directory:
             self.directory_to_backup = command_line_options.directory
             self.directory_to_backup_from = OptionFrom.COMMAND_LINE
@@ -90,6 +96,25 @@ class GibSetup:
             self.branch = 'master'
             self.branch_from = OptionFrom.DEFAULT_VALUE
 
+        # The mirrors of nested repositories for each branch are in
+        # git-repositories/<BRANCH>/, next to the shared store (see
+        # repositorystore.py), so a branch can't be called the same:
+
+        if self.branch.split('/')[0] == store_leafname:
+            message = ("The branch name '{}' is reserved: nested "
+                       "repositories are stored in git-repositories/{}")
+            print_stderr(message.format(self.branch, store_leafname))
+            sys.exit(Errors.RESERVED_BRANCH_NAME)
+
+        # Files at least this big are split into chunks (see
+        # chunking.py), if the option is set:
+
+        self.chunk_threshold = None
+        if configuration.has_option('repository','chunk_threshold'):
+            self.chunk_threshold = parse_size(
+                configuration.get('repository','chunk_threshold')
+            )
+
         # Check that the git_directory ends in '.git':
 
         if not re.search('\.git/*$',self.git_directory):
@@ -97,13 +122,22 @@ class GibSetup:
             print_stderr(message.format(self.git_directory))
             sys.exit(Errors.BAD_GIT_DIRECTORY)
 
-        # Also check that it actually exists:
+        # Also check that it actually exists, unless the command will
+        # create it:
 
-        if not os.path.exists(self.git_directory):
+        if git_directory_must_exist and \
+                not os.path.exists(self.git_directory):
             message = "The git directory '{}' does not exist."
             print_stderr(message.format(self.git_directory))
             sys.exit(Errors.GIT_DIRECTORY_MISSING)
 
+        # Each branch has its own index, so that switching between
+        # backing up different directories to the same repository
+        # doesn't lose the stat information that git keeps in the
+        # index.  Every git command we run uses it:
+
+        os.environ["GIT_INDEX_FILE"] = self.get_index_file()
+
     def get_directory_to_backup(self):
         return self.directory_to_backup
 
@@ -119,6 +153,19 @@ class GibSetup:
     def get_branch(self):
         return self.branch
 
+    def get_chunk_threshold(self):
+        return self.chunk_threshold
+
+    def get_branch_ref(self):
+        return "refs/heads/" + self.branch
+
+    def get_index_file(self):
+        return os.path.join(
+            self.get_git_directory(),
+            'gib-indexes',
+            self.get_branch()
+        )
+
     def print_settings(self):
         print_stderr('''Settings for backup:
 backing up the directory {} (set from the {})
@@ -146,10 +193,32 @@ backing up the directory {} (set from the {})
             invocation += shellquote(self.directory_to_backup)
         return invocation
 
+    @contextmanager
+    def locked(self):
+        '''Hold the repository's lock for the duration of the with
+        statement.  This should be held for any step that changes state
+        that is shared between the branches, such as refs, HEAD and the
+        config, so that several directories can be backed up to the
+        same repository at the same time.  It may be nested.'''
+        if self.lock_depth > 0:
+            self.lock_depth += 1
+            try:
+                yield
+            finally:
+                self.lock_depth -= 1
+            return
+        with lock_file(os.path.join(self.git_directory,"gib.lock")):
+            self.lock_depth = 1
+            try:
+                yield
+            finally:
+                self.lock_depth = 0
+
     def git(self,rest_of_command):
         '''Create an list (suitable for passing to subprocess.call or
         subprocess.check_call) which runs a git command with the correct
-        git directory and work tree'''
+        git directory and work tree.  (The branch's index file is
+        selected by GIT_INDEX_FILE in the environment.)'''
         return [ "git",
                  "--git-dir="+self.git_directory,
                  "--work-tree="+self.directory_to_backup ] + rest_of_command
@@ -157,7 +226,8 @@ backing up the directory {} (set from the {})
     def git_for_shell(self):
         '''Returns a string with shell-safe invocation of git which can be used
         in calls that are subject to shell interpretation.'''
-        command = "git --git-dir="+shellquote(self.git_directory)
+        command = "GIT_INDEX_FILE="+shellquote(self.get_index_file())
+        command += " git --git-dir="+shellquote(self.git_directory)
         command += " --work-tree="+shellquote(self.directory_to_backup)
         return command
 
@@ -217,15 +287,59 @@ backing up the directory {} (set from the {})
         else:
             return False
 
-    def switch_to_correct_branch(self):
-        self.set_HEAD_to(self.branch)
-        self.abort_unless_HEAD_exists()
-        # Also reset the index to match HEAD.  Otherwise things go
-        # horribly wrong when switching from backing up one computer to
-        # another, since the index is still that from the first one.
-        msg = "Now working on a new branch, so resetting the index to match..."
-        print_stderr(msg)
-        check_call(self.git(["read-tree","HEAD"]))
+    def prepare_index(self):
+        '''Make sure that the index file for this branch exists.  If
+        there is none yet, then the shared index is used if HEAD points
+        to this branch (as it would have been with earlier versions of
+        gib), or otherwise the index is created from the branch.'''
+        index_file = self.get_index_file()
+        if os.path.exists(index_file):
+            return
+        mkdir_p(os.path.dirname(index_file))
+        shared_index = os.path.join(self.git_directory,"index")
+        if os.path.exists(shared_index) and self.currently_on_correct_branch():
+            shutil.copyfile(shared_index,index_file)
+        elif self.check_ref(self.get_branch_ref()):
+            print_stderr("Creating the index for the branch " + self.branch)
+            check_call(self.git(["read-tree",self.get_branch_ref()]))
+
+    def commit(self,message):
+        '''Commit the tree in this branch's index to the branch, without
+        using or changing HEAD.  Returns the new commit's object name,
+        or None if the tree is the same as in the last commit.'''
+        tree = check_output(self.git(["write-tree"])).decode().strip()
+        with self.locked():
+            return self.commit_tree(tree,message)
+
+    def commit_tree(self,tree,message):
+        '''Commit "tree" to the branch with "message"; this should only
+        be called with the lock held.'''
+        branch_ref = self.get_branch_ref()
+        parent = None
+        if self.check_ref(branch_ref):
+            parent = check_output(
+                self.git(["rev-parse","--verify",branch_ref])
+            ).decode().strip()
+            parent_tree = check_output(
+                self.git(["rev-parse","--verify",parent+"^{tree}"])
+            ).decode().strip()
+            if parent_tree == tree:
+                print_stderr("Nothing has changed since the last commit.")
+                return None
+        command = ["commit-tree",tree,"-m",message]
+        if parent:
+            command += ["-p",parent]
+        new_commit = check_output(self.git(command)).decode().strip()
+        check_call(self.git([
+            "update-ref",
+            "-m",
+            "gib: " + message,
+            branch_ref,
+            new_commit,
+            parent or "0" * 40
+        ]))
+        print_stderr("[{} {}] {}".format(self.branch,new_commit[:7],message))
+        return new_commit
 
     def config_value(self,key):
         '''Retrieve the git config value for "key", or return
@@ -239,10 +353,12 @@ backing up the directory {} (set from the {})
             return None
 
     def set_config_value(self,key,value):
-        check_call(self.git(["config",key,value]))
+        with self.locked():
+            check_call(self.git(["config",key,value]))
 
     def unset_config_value(self,key):
-        call(self.git(["config","--unset",key]))
+        with self.locked():
+            call(self.git(["config","--unset",key]))
 
     def abort_unless_particular_config(self,key,required_value):
         '''Unless the git config has "required_value" set for "key", exit.'''
@@ -265,8 +381,8 @@ backing up the directory {} (set from the {})
         '''Exit unless git config has gc.auto set to "0"'''
         self.abort_unless_particular_config("gc.auto","0")
 
-    def abort_unless_HEAD_exists(self):
-        if not self.check_ref("HEAD"):
+    def abort_unless_branch_exists(self):
+        if not self.check_ref(self.get_branch_ref()):
             message = '''The branch you are trying to back up to does not exist.
 (Perhaps you haven't run "{} init")'''
             print_stderr(message.format(self.get_invocation()))
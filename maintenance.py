@@ -0,0 +1,152 @@
+# gib sets gc.auto to 0, so that git never decides to repack the
+# repository in the middle of a backup.  Instead, "gib maintain" does
+# the equivalent work in a series of steps that each leave the
+# repository in a consistent state, stopping once its time limit has
+# been used up:
+#
+#   pack-loose-objects - pack the loose objects in batches, like the
+#                        loose-objects task of "git maintenance"
+#
+#   geometric-repack   - combine the smaller packs so that their sizes
+#                        form a geometric progression, which only ever
+#                        rewrites a small fraction of the repository,
+#                        and write a multi-pack-index with reachability
+#                        bitmaps
+#
+#   commit-graph       - add the new commits to the commit-graph, with
+#                        changed-path Bloom filters for history queries
+#
+# None of these steps may ever prune unreachable objects (so no
+# "repack -a -d" without --keep-unreachable, "gc" or "prune"): "gib
+# commit" writes objects without holding the repository lock, so a
+# maintenance run can see objects that a backup in progress has written
+# but not yet made reachable from any ref.
+#
+# The step that the next run should start with is recorded in the
+# file gib-maintenance in the git directory, so an interrupted run
+# resumes where it left off rather than starting again.
+
+import json
+import os
+import time
+from subprocess import check_call, Popen, PIPE
+
+progress_leafname = 'gib-maintenance'
+
+# The maximum number of loose objects to put in each new pack:
+loose_objects_batch_size = 50000
+
+class Maintenance:
+    '''Maintenance of the repository in "git_directory", using "jobs"
+    threads to compress objects'''
+
+    steps = ['pack-loose-objects', 'geometric-repack', 'commit-graph']
+
+    def __init__(self, git_directory, jobs=1):
+        self.git_directory = git_directory
+        self.jobs = jobs
+        self.progress_filename = os.path.join(git_directory, progress_leafname)
+
+    def git(self, rest_of_command):
+        return ["git", "--git-dir=" + self.git_directory,
+                "-c", "pack.threads={}".format(self.jobs)] + rest_of_command
+
+    def load_progress(self):
+        try:
+            with open(self.progress_filename) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_progress(self, progress):
+        with open(self.progress_filename + '.tmp', 'w') as f:
+            json.dump(progress, f, indent=1, sort_keys=True)
+        os.rename(self.progress_filename + '.tmp', self.progress_filename)
+
+    def count_objects(self):
+        '''Return a dictionary of the statistics from "git count-objects
+        -v", e.g. "count" (loose objects) and "packs"'''
+        p = Popen(self.git(["count-objects", "-v"]), stdout=PIPE)
+        output = p.communicate()[0].decode()
+        result = {}
+        for line in output.splitlines():
+            key, value = line.split(':', 1)
+            result[key] = value.strip()
+        return result
+
+    def run(self, time_limit, report=None):
+        '''Run the maintenance steps, starting from the one that the
+        last run didn't finish, until they have all been done or
+        "time_limit" seconds have passed.  Each step that is started
+        is allowed to finish.  "report", if supplied, is called with a
+        description of each step.  Returns True if every step was
+        completed.'''
+        report = report or (lambda message: None)
+        deadline = time.time() + time_limit
+        progress = self.load_progress()
+        next_step = progress.get('next', self.steps[0])
+        if next_step not in self.steps:
+            next_step = self.steps[0]
+        for step in self.steps[self.steps.index(next_step):]:
+            if time.time() >= deadline:
+                report("The time limit was reached before: " + step)
+                progress['next'] = step
+                self.save_progress(progress)
+                return False
+            start_time = time.time()
+            report("Starting: " + step)
+            finished = getattr(self, step.replace('-', '_'))(deadline)
+            report("{} {} in {:.2f}s".format(
+                "Finished" if finished else "Stopped",
+                step,
+                time.time() - start_time
+            ))
+            if not finished:
+                progress['next'] = step
+                self.save_progress(progress)
+                return False
+            progress.setdefault('completed', {})[step] = int(time.time())
+            progress['next'] = self.steps[
+                (self.steps.index(step) + 1) % len(self.steps)
+            ]
+            self.save_progress(progress)
+        return True
+
+    def loose_objects(self):
+        objects_directory = os.path.join(self.git_directory, 'objects')
+        for entry in os.scandir(objects_directory):
+            if len(entry.name) != 2 or not entry.is_dir():
+                continue
+            for object_entry in os.scandir(entry.path):
+                if len(object_entry.name) == 38:
+                    yield entry.name + object_entry.name
+
+    def pack_loose_objects(self, deadline):
+        loose = list(self.loose_objects())
+        while loose:
+            batch = loose[:loose_objects_batch_size]
+            loose = loose[loose_objects_batch_size:]
+            base_name = os.path.join(self.git_directory, 'objects', 'pack', 'pack')
+            p = Popen(self.git(["pack-objects", "--quiet", base_name]),
+                      stdin=PIPE, stdout=PIPE)
+            p.communicate(''.join(o + '\n' for o in batch).encode())
+            if p.returncode != 0:
+                raise Exception("Packing loose objects failed")
+            check_call(self.git(["prune-packed", "--quiet"]))
+            if loose and time.time() >= deadline:
+                return False
+        return True
+
+    def geometric_repack(self, deadline):
+        check_call(self.git([
+            "repack", "-d", "-l", "--quiet", "--geometric=2",
+            "--write-midx", "--write-bitmap-index"
+        ]))
+        return True
+
+    def commit_graph(self, deadline):
+        check_call(self.git([
+            "commit-graph", "write", "--reachable", "--changed-paths",
+            "--split", "--no-progress"
+        ]))
+        return True
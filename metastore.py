@@ -0,0 +1,174 @@
+# Reading and writing the .ometastore file, which records the owner,
+# group, permissions, modification time and extended attributes of
+# every file that is backed up.  This is the same binary format that
+# the ometastore program (see ometastore.ml) reads and writes:
+#
+#   "Ometastore\n" "1.0.1\n"
+#
+# ... followed by one record for each entry, sorted by path:
+#
+#   2 bytes   - the number of leading bytes shared with the previous path
+#   xstring   - the rest of the path
+#   xstring   - owner name
+#   xstring   - group name
+#   xstring   - mtime, formatted as by OCaml's string_of_float
+#   2 bytes   - permission bits
+#   1 byte    - the kind of file (see kind_codes below)
+#   2 bytes   - the number of extended attributes, followed by an
+#               xstring for each name and value
+#
+# An xstring is a 2 byte length followed by that many bytes, and all
+# integers are big-endian.
+
+from collections import namedtuple
+from functools import lru_cache
+import grp
+import os
+import pwd
+import stat
+
+magic = b'Ometastore'
+version = b'1.0.1'
+
+MetadataEntry = namedtuple(
+    'MetadataEntry',
+    ['path', 'owner', 'group', 'mtime', 'mode', 'kind', 'xattrs']
+)
+
+# The values of OCaml's Unix.file_kind, in the order that ometastore
+# numbers them:
+kind_codes = [
+    stat.S_IFREG, stat.S_IFDIR, stat.S_IFCHR, stat.S_IFBLK,
+    stat.S_IFLNK, stat.S_IFIFO, stat.S_IFSOCK
+]
+
+def kind_code(mode):
+    '''Return ometastore's number for the type of file in "mode"'''
+    return kind_codes.index(stat.S_IFMT(mode))
+
+def format_mtime(mtime):
+    '''Format the float "mtime" as OCaml's string_of_float would'''
+    result = '%.12g' % mtime
+    if all(c in '0123456789-' for c in result):
+        result += '.'
+    return result.encode()
+
+def xstring(s):
+    return len(s).to_bytes(2, 'big') + s
+
+def common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+def write_metastore(filename, entries):
+    '''Write the MetadataEntry tuples in "entries" to "filename" in
+    ometastore's format, sorted by path.  The path, owner, group and
+    extended attribute names and values should all be bytes.'''
+    with open(filename, 'wb') as f:
+        f.write(magic + b'\n' + version + b'\n')
+        previous = b''
+        for e in sorted(entries):
+            prefix = common_prefix_length(previous, e.path)
+            record = [
+                prefix.to_bytes(2, 'big'),
+                xstring(e.path[prefix:]),
+                xstring(e.owner),
+                xstring(e.group),
+                xstring(format_mtime(e.mtime)),
+                e.mode.to_bytes(2, 'big'),
+                e.kind.to_bytes(1, 'big'),
+                len(e.xattrs).to_bytes(2, 'big')
+            ]
+            for name, value in e.xattrs:
+                record.append(xstring(name))
+                record.append(xstring(value))
+            f.write(b''.join(record))
+            previous = e.path
+
+def read_exactly(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise Exception("The .ometastore file was truncated")
+    return data
+
+def read_integer(f, n):
+    return int.from_bytes(read_exactly(f, n), 'big')
+
+def read_xstring(f):
+    return read_exactly(f, read_integer(f, 2))
+
+def read_metastore(f):
+    '''Generate a MetadataEntry for each record in the file object "f",
+    which is in ometastore's format, reading it as a stream.  The mtime
+    of each entry is a float.  An empty file has no entries.'''
+    header = f.readline()
+    if not header:
+        return
+    if header != magic + b'\n':
+        raise Exception("This is not an .ometastore file")
+    f.readline()
+    previous = b''
+    while True:
+        prefix_bytes = f.read(2)
+        if not prefix_bytes:
+            return
+        if len(prefix_bytes) != 2:
+            raise Exception("The .ometastore file was truncated")
+        prefix = int.from_bytes(prefix_bytes, 'big')
+        path = previous[:prefix] + read_xstring(f)
+        owner = read_xstring(f)
+        group = read_xstring(f)
+        mtime = float(read_xstring(f))
+        mode = read_integer(f, 2)
+        kind = read_integer(f, 1)
+        xattrs = [ (read_xstring(f), read_xstring(f))
+                   for i in range(read_integer(f, 2)) ]
+        yield MetadataEntry(path, owner, group, mtime, mode, kind, xattrs)
+        previous = path
+
+@lru_cache(maxsize=None)
+def uid_for(owner):
+    try:
+        return pwd.getpwnam(os.fsdecode(owner)).pw_uid
+    except KeyError:
+        return -1
+
+@lru_cache(maxsize=None)
+def gid_for(group):
+    try:
+        return grp.getgrnam(os.fsdecode(group)).gr_gid
+    except KeyError:
+        return -1
+
+def apply_metadata(filename, entry):
+    '''Set the owner, group, permissions, extended attributes and
+    modification time of "filename" from the MetadataEntry "entry", as
+    far as possible.  Nothing is changed if "filename" is a different
+    kind of file from the one that was recorded.  Returns False if
+    that was the case or "filename" doesn't exist.'''
+    try:
+        s = os.lstat(filename)
+    except OSError:
+        return False
+    if kind_code(s.st_mode) != entry.kind:
+        return False
+    is_link = stat.S_ISLNK(s.st_mode)
+    try:
+        os.chown(filename, uid_for(entry.owner), gid_for(entry.group),
+                 follow_symlinks=False)
+    except OSError:
+        # Usually only root can change the owner.
+        pass
+    # Linux doesn't support permissions on symbolic links:
+    if not is_link:
+        os.chmod(filename, entry.mode)
+    for name, value in entry.xattrs:
+        try:
+            os.setxattr(filename, name, value, follow_symlinks=False)
+        except OSError:
+            pass
+    os.utime(filename, (entry.mtime, entry.mtime), follow_symlinks=False)
+    return True
@@ -0,0 +1,434 @@
+# A persistent index of every version of every path that has been
+# committed to the backup repository.  The index is an SQLite database
+# kept in the git directory, and is updated incrementally: only
+# commits that have been added to a branch since the last update are
+# read, using one "git diff-tree --stdin" process per branch.
+#
+# Each row of the "versions" table records that a particular blob (or
+# submodule commit) was at a path on a branch from first_commit until
+# last_commit, inclusive.  If the version is still present in the tip
+# of the branch, last_commit is NULL.  Its size is the size of the
+# file, so for a file that is stored in chunks it is the total size of
+# the chunks rather than that of the manifest blob.
+#
+# Since there's a row for each change to each path, looking up the
+# history of one path (see history()) only reads that path's rows and
+# the commits they refer to, however many commits there are.
+
+from collections import namedtuple
+import os
+import re
+import sqlite3
+from subprocess import call, check_output
+
+from chunking import chunked_list_filename, parse_chunked_list, parse_manifest
+from githelpers import CatFileBatch, CatFileBatchCheck
+from general import lock_file
+from plumbing import diff_tree
+
+index_leafname = 'gib-index.sqlite'
+lock_leafname = 'gib-index.lock'
+schema_version = '2'
+
+schema = '''
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS branches (
+    branch TEXT PRIMARY KEY,
+    tip TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS commits (
+    branch TEXT NOT NULL,
+    commit_name TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    date INTEGER NOT NULL,
+    PRIMARY KEY (branch, commit_name)
+);
+CREATE INDEX IF NOT EXISTS commits_by_seq
+    ON commits (branch, seq);
+CREATE TABLE IF NOT EXISTS paths (
+    id INTEGER PRIMARY KEY,
+    path BLOB UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS versions (
+    id INTEGER PRIMARY KEY,
+    branch TEXT NOT NULL,
+    path_id INTEGER NOT NULL,
+    object_name TEXT NOT NULL,
+    mode INTEGER NOT NULL,
+    size INTEGER,
+    first_commit TEXT NOT NULL,
+    last_commit TEXT
+);
+CREATE INDEX IF NOT EXISTS versions_by_path
+    ON versions (path_id, branch);
+CREATE INDEX IF NOT EXISTS versions_by_branch
+    ON versions (branch, last_commit);
+'''
+
+# One entry in the history of a path.  "object_name" is None if the
+# path was deleted in "commit"; for a directory it is the tree, and
+# "size" is the total size of the files in it.
+Version = namedtuple(
+    'Version',
+    ['number', 'branch', 'commit', 'date', 'object_name', 'mode', 'size']
+)
+
+class FileSizes:
+    '''Finds the size of each file added to a branch while it is being
+    indexed, keeping track of which paths are stored in chunks.
+    "old_tip" is the last commit already indexed, if any.'''
+
+    def __init__(self, git_command, old_tip):
+        self.check = CatFileBatchCheck(git_command)
+        self.cat_file = CatFileBatch(git_command)
+        self.chunked = set()
+        if old_tip is not None:
+            self.read_chunked_list(old_tip + ':' + chunked_list_filename)
+
+    def read_chunked_list(self, name):
+        result = self.cat_file.read_object(name)
+        self.chunked = parse_chunked_list(result[2]) if result else set()
+
+    def size(self, path, mode, object_name):
+        if mode == 0o160000:
+            # A nested git repository has no size of its own:
+            return None
+        if path in self.chunked:
+            result = self.cat_file.read_object(object_name)
+            chunks = parse_manifest(result[2]) if result else None
+            if chunks is not None:
+                return sum(size for chunk_name, size in chunks)
+        info = self.check.object_info(object_name)
+        return info[2] if info else None
+
+    def close(self):
+        self.check.close()
+        self.cat_file.close()
+
+class PathIndex:
+    '''The on-disk index of paths for the repository in "git_directory".'''
+
+    def __init__(self, git_directory):
+        self.git_directory = git_directory
+        self.filename = os.path.join(git_directory, index_leafname)
+        self.lock_filename = os.path.join(git_directory, lock_leafname)
+        self.connection = None
+
+    def git(self, rest_of_command):
+        return ["git", "--git-dir=" + self.git_directory] + rest_of_command
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def connect(self):
+        '''Open the database, creating it (or recreating it, if it was
+        written by an incompatible version of this module) as
+        necessary.'''
+        if self.connection:
+            return self.connection
+        self.connection = sqlite3.connect(self.filename)
+        self.connection.executescript(schema)
+        row = self.connection.execute(
+            "SELECT value FROM metadata WHERE key = 'schema_version'"
+        ).fetchone()
+        if row and row[0] != schema_version:
+            self.connection.close()
+            os.remove(self.filename)
+            self.connection = None
+            return self.connect()
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO metadata VALUES ('schema_version', ?)",
+                (schema_version,)
+            )
+        return self.connection
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def branch_heads(self):
+        '''Return a dictionary mapping each branch name to the object
+        name of its tip.'''
+        output = check_output(self.git([
+            "for-each-ref",
+            "--format=%(objectname) %(refname:strip=2)",
+            "refs/heads/"
+        ]))
+        result = {}
+        for line in output.decode().splitlines():
+            object_name, branch = line.split(' ', 1)
+            result[branch] = object_name
+        return result
+
+    def is_ancestor(self, possible_ancestor, commit):
+        return 0 == call(self.git([
+            "merge-base", "--is-ancestor", possible_ancestor, commit
+        ]))
+
+    def update(self, progress=None):
+        '''Bring the index up to date with every branch in the
+        repository.  "progress", if supplied, is called with a message
+        for each branch that has new commits.  This holds the index's
+        own lock, so that it is never updated by two processes at once,
+        but doesn't need the repository's.'''
+        with lock_file(self.lock_filename):
+            self.update_unlocked(progress)
+
+    def update_unlocked(self, progress):
+        connection = self.connect()
+        heads = self.branch_heads()
+        known = dict(connection.execute("SELECT branch, tip FROM branches"))
+        for branch in known:
+            if branch not in heads:
+                with connection:
+                    self.forget_branch(branch)
+        for branch, tip in sorted(heads.items()):
+            old_tip = known.get(branch)
+            if old_tip == tip:
+                continue
+            with connection:
+                if old_tip and not self.is_ancestor(old_tip, tip):
+                    # The branch has been rewritten, so start again:
+                    self.forget_branch(branch)
+                    old_tip = None
+                self.ingest(branch, old_tip, tip, progress)
+
+    def forget_branch(self, branch):
+        for table in ('branches', 'commits', 'versions'):
+            self.connection.execute(
+                "DELETE FROM {} WHERE branch = ?".format(table),
+                (branch,)
+            )
+
+    def path_id(self, path, path_ids):
+        '''Return the id in the paths table of "path" (bytes), adding it
+        if necessary.  "path_ids" is a cache of ids already looked up.'''
+        if path in path_ids:
+            return path_ids[path]
+        connection = self.connection
+        row = connection.execute(
+            "SELECT id FROM paths WHERE path = ?", (path,)
+        ).fetchone()
+        if row:
+            result = row[0]
+        else:
+            result = connection.execute(
+                "INSERT INTO paths (path) VALUES (?)", (path,)
+            ).lastrowid
+        path_ids[path] = result
+        return result
+
+    def ingest(self, branch, old_tip, tip, progress=None):
+        '''Add every commit on the first-parent history of "tip" that
+        is not in the history of "old_tip" to the index.'''
+        connection = self.connection
+        rev_range = tip if old_tip is None else old_tip + '..' + tip
+        log_output = check_output(self.git([
+            "log", "--first-parent", "--reverse", "--format=%H %ct %P",
+            rev_range
+        ])).decode()
+        commits = []
+        for line in log_output.splitlines():
+            fields = line.split()
+            commits.append((fields[0], int(fields[1]),
+                            fields[2] if len(fields) > 2 else None))
+        if progress and commits:
+            message = "Indexing {} new commit(s) on the branch {}"
+            progress(message.format(len(commits), branch))
+        row = connection.execute(
+            "SELECT MAX(seq) FROM commits WHERE branch = ?", (branch,)
+        ).fetchone()
+        next_seq = 0 if row[0] is None else row[0] + 1
+        connection.executemany(
+            "INSERT OR REPLACE INTO commits VALUES (?, ?, ?, ?)",
+            ((branch, c, next_seq + i, date)
+             for i, (c, date, parent) in enumerate(commits))
+        )
+        parents = dict((c, parent) for c, date, parent in commits)
+        path_ids = {}
+        sizes = FileSizes(self.git([]), old_tip)
+        try:
+            for commit, changes in self.diff_commits(commits):
+                self.apply_changes(
+                    branch, commit, parents[commit], changes, path_ids, sizes
+                )
+        finally:
+            sizes.close()
+        connection.execute(
+            "INSERT OR REPLACE INTO branches VALUES (?, ?)", (branch, tip)
+        )
+
+    def diff_commits(self, commits):
+        '''Generate (commit, changes) for each of the (commit, date,
+        parent) tuples in "commits" that changes anything, where changes
+        is a list of (status, mode, object_name, path) tuples.'''
+        input_lines = (
+            (commit if parent is None else commit + ' ' + parent).encode()
+            for commit, date, parent in commits
+        )
+        commit = None
+        changes = []
+        for entry in diff_tree(self.git([]), ["-r", "--root", "--stdin"],
+                               input_lines):
+            if isinstance(entry, str):
+                if commit is not None:
+                    yield commit, changes
+                commit = entry
+                changes = []
+            else:
+                changes.append((entry.status, entry.new_mode,
+                                entry.new_object_name, entry.path))
+        if commit is not None:
+            yield commit, changes
+
+    def apply_changes(self, branch, commit, parent, changes, path_ids, sizes):
+        connection = self.connection
+        closed = []
+        added = []
+        # The list of chunked files must be up to date before the sizes
+        # of the files this commit adds are found:
+        for status, mode, object_name, path in changes:
+            if path == chunked_list_filename.encode():
+                if status == 'D':
+                    sizes.chunked = set()
+                else:
+                    sizes.read_chunked_list(object_name)
+        for status, mode, object_name, path in changes:
+            path_id = self.path_id(path, path_ids)
+            if status != 'A':
+                closed.append((parent, branch, path_id))
+            if status != 'D':
+                added.append((branch, path_id, object_name, mode,
+                              sizes.size(path, mode, object_name), commit))
+        connection.executemany(
+            '''UPDATE versions SET last_commit = ?
+               WHERE branch = ? AND path_id = ? AND last_commit IS NULL''',
+            closed
+        )
+        connection.executemany(
+            '''INSERT INTO versions
+               (branch, path_id, object_name, mode, size, first_commit)
+               VALUES (?, ?, ?, ?, ?, ?)''',
+            added
+        )
+
+    def search(self, path_regexp, branch=None, all_history=True):
+        '''Generate (branch, path, object_name, mode, first_commit,
+        last_commit) for every indexed version of a path matching
+        "path_regexp".  "last_commit" is the tip of the branch for
+        versions that are still present there.  The path is returned
+        as bytes, exactly as it is in the repository.'''
+        connection = self.connect()
+        compiled_re = re.compile(path_regexp)
+        connection.create_function(
+            "gib_path_matches", 1,
+            lambda path: compiled_re.search(os.fsdecode(path)) is not None
+        )
+        query = '''
+            SELECT v.branch, p.path, v.object_name, v.mode, v.first_commit,
+                   COALESCE(v.last_commit, b.tip)
+            FROM paths p
+            JOIN versions v ON v.path_id = p.id
+            JOIN branches b ON b.branch = v.branch
+            WHERE gib_path_matches(p.path)'''
+        parameters = []
+        if branch is not None:
+            query += " AND v.branch = ?"
+            parameters.append(branch)
+        if not all_history:
+            query += " AND v.last_commit IS NULL"
+        query += " ORDER BY v.branch, p.path, v.id"
+        for row in connection.execute(query, parameters):
+            yield row
+
+    def history(self, path, branch=None):
+        '''Return a list of the Versions of "path" (bytes, relative to
+        the top of the tree, or b"" for the whole tree) on "branch", or
+        on every branch if "branch" is None, oldest first and numbered
+        from 1 on each branch.  There is a new version of a file at each
+        commit that changed or removed it, and of a directory at each
+        commit that changed anything in it.'''
+        connection = self.connect()
+        path = path.strip(b'/')
+        query = '''
+            SELECT v.branch, p.path, v.object_name, v.mode, v.size,
+                   fc.seq, lc.seq
+            FROM paths p
+            CROSS JOIN versions v ON v.path_id = p.id
+            JOIN commits fc
+                ON fc.branch = v.branch AND fc.commit_name = v.first_commit
+            LEFT JOIN commits lc
+                ON lc.branch = v.branch AND lc.commit_name = v.last_commit'''
+        conditions = []
+        parameters = []
+        if path:
+            # Everything in a directory sorts between "path/" and "path0":
+            conditions.append("(p.path = ? OR (p.path >= ? AND p.path < ?))")
+            parameters += [path, path + b'/', path + b'0']
+        if branch is not None:
+            conditions.append("v.branch = ?")
+            parameters.append(branch)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        # CROSS JOIN makes SQLite find the paths first and then their
+        # versions through versions_by_path, rather than reading every
+        # version on the branch.
+        rows_by_branch = {}
+        for row in connection.execute(query, parameters):
+            rows_by_branch.setdefault(row[0], []).append(row[1:])
+        result = []
+        for branch_name, rows in sorted(rows_by_branch.items()):
+            result += self.branch_history(branch_name, path, rows)
+        return result
+
+    def branch_history(self, branch, path, rows):
+        '''Return the Versions of "path" on "branch", given the rows of
+        the versions table for it (or for everything in it)'''
+        connection = self.connection
+        is_file = path and any(p == path for p, *rest in rows)
+        if is_file:
+            rows = [ row for row in rows if row[0] == path ]
+        starting = {}
+        ending = {}
+        for row in rows:
+            first_seq, last_seq = row[4], row[5]
+            starting.setdefault(first_seq, []).append(row)
+            if last_seq is not None:
+                ending.setdefault(last_seq + 1, []).append(row)
+        check = None if is_file else CatFileBatchCheck(self.git([]))
+        live = {}
+        result = []
+        try:
+            for seq in sorted(set(starting) | set(ending)):
+                for row in ending.get(seq, []):
+                    del live[row[0]]
+                for row in starting.get(seq, []):
+                    live[row[0]] = row
+                commit, date = connection.execute(
+                    '''SELECT commit_name, date FROM commits
+                       WHERE branch = ? AND seq = ?''',
+                    (branch, seq)
+                ).fetchone()
+                object_name, mode, size = None, None, None
+                if is_file and path in live:
+                    object_name, mode, size = live[path][1:4]
+                elif not is_file and live:
+                    if path:
+                        name = commit + ':' + os.fsdecode(path)
+                    else:
+                        name = commit + '^{tree}'
+                    info = check.object_info(name)
+                    object_name = info[0] if info else None
+                    mode = 0o40000
+                    size = sum(row[3] or 0 for row in live.values())
+                result.append(Version(len(result) + 1, branch, commit, date,
+                                      object_name, mode, size))
+        finally:
+            if check:
+                check.close()
+        return result
@@ -0,0 +1,135 @@
+# Streaming parsers for the output of the git plumbing commands that
+# gib uses.  Each function runs the command and generates a tuple for
+# each record of its output as it arrives, parsing the fields by
+# looking for the separating bytes rather than with regular
+# expressions, so that memory use stays the same however large the
+# repository is.  Paths are always bytes, modes are integers and
+# object names are strings.
+#
+# If the command fails, GitCommandFailed is raised once its output has
+# all been read.
+
+from collections import namedtuple
+from subprocess import Popen, PIPE
+import threading
+
+from general import file_iter_bytes_records
+
+IndexEntry = namedtuple('IndexEntry', ['mode', 'object_name', 'stage', 'path'])
+
+TreeEntry = namedtuple('TreeEntry', ['mode', 'type', 'object_name', 'path'])
+
+# For renames and copies, "old_path" is the source of the change:
+DiffEntry = namedtuple(
+    'DiffEntry',
+    ['old_mode', 'new_mode', 'old_object_name', 'new_object_name',
+     'status', 'path', 'old_path']
+)
+
+class GitCommandFailed(Exception):
+    pass
+
+def records(command, separator=b'\0', input_lines=None):
+    '''Run "command" and generate each record (bytes) of its output.
+    If "input_lines" is supplied, each of them is written to the
+    command's standard input, followed by a newline, from another
+    thread.'''
+    p = Popen(command, stdin=PIPE if input_lines is not None else None,
+              stdout=PIPE)
+    feeder = None
+    if input_lines is not None:
+        def feed():
+            try:
+                for line in input_lines:
+                    p.stdin.write(line + b'\n')
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+    try:
+        for record in file_iter_bytes_records(p.stdout, separator, b''):
+            yield record
+    finally:
+        p.stdout.close()
+        returncode = p.wait()
+        if feeder:
+            feeder.join()
+    if returncode != 0:
+        raise GitCommandFailed("'{}' failed".format(' '.join(command)))
+
+def lines(command):
+    '''Run "command" and generate each line of its output as a string'''
+    for record in records(command, b'\n'):
+        yield record.decode()
+
+def ls_files_stage(git_command, options=()):
+    '''Generate an IndexEntry for each entry in the index, from "git
+    ls-files -s -z" with any extra "options"'''
+    command = git_command + ["ls-files", "-s", "-z"] + list(options)
+    for record in records(command):
+        if not record:
+            continue
+        # <MODE> SP <OBJECT> SP <STAGE> TAB <PATH>
+        space = record.index(b' ')
+        second_space = record.index(b' ', space + 1)
+        tab = record.index(b'\t', second_space)
+        yield IndexEntry(
+            int(record[:space], 8),
+            record[space+1:second_space].decode(),
+            int(record[second_space+1:tab]),
+            record[tab+1:]
+        )
+
+def ls_tree(git_command, tree, recursive=True, options=()):
+    '''Generate a TreeEntry for each entry in "tree", from "git ls-tree
+    -z" with any extra "options"'''
+    command = git_command + ["ls-tree", "-z"]
+    if recursive:
+        command.append("-r")
+    command += list(options) + [tree]
+    for record in records(command):
+        if not record:
+            continue
+        # <MODE> SP <TYPE> SP <OBJECT> TAB <PATH>
+        space = record.index(b' ')
+        second_space = record.index(b' ', space + 1)
+        tab = record.index(b'\t', second_space)
+        yield TreeEntry(
+            int(record[:space], 8),
+            record[space+1:second_space].decode(),
+            record[second_space+1:tab].decode(),
+            record[tab+1:]
+        )
+
+def diff_tree(git_command, options, input_lines=None):
+    '''Run "git diff-tree -z" with "options" and generate a DiffEntry for
+    each change.  When diff-tree outputs the name of the commit being
+    compared (e.g. with --stdin, to which "input_lines" are written),
+    that name is generated as a string before the commit's changes.'''
+    command = git_command + ["diff-tree", "-z"] + list(options)
+    iterator = records(command, input_lines=input_lines)
+    for record in iterator:
+        if not record:
+            continue
+        if not record.startswith(b':'):
+            yield record.decode()
+            continue
+        # :<OLD-MODE> SP <NEW-MODE> SP <OLD> SP <NEW> SP <STATUS>, then
+        # the path (or two paths, for a rename or copy) in the
+        # following records:
+        fields = record[1:].split(b' ')
+        status = fields[4].decode()
+        path = next(iterator)
+        old_path = None
+        if status[0] in 'RC':
+            old_path, path = path, next(iterator)
+        yield DiffEntry(
+            int(fields[0], 8),
+            int(fields[1], 8),
+            fields[2].decode(),
+            fields[3].decode(),
+            status,
+            path,
+            old_path
+        )
@@ -0,0 +1,349 @@
+# Profiling of a single run of gib, enabled with "gib --profile" or by
+# setting GIB_TRACE to the name of a file to write the trace to.
+#
+# The time spent in each phase of a command (marked in gib with
+# "with phase(...)") is recorded, in wall-clock time, CPU time in gib
+# itself and CPU time in the subprocesses that finished during it.
+# Every subprocess that gib starts is also recorded, whichever helper
+# started it, by wrapping subprocess.Popen: its arguments, how long it
+# ran for and how many bytes were written to and read from its pipes.
+# Counts of what was processed (e.g. files and bytes added) can be
+# added with count().
+#
+# At exit a summary table is printed to standard error, and the trace
+# is written in the Chrome trace event format, so it can be opened
+# with chrome://tracing or https://ui.perfetto.dev/ to see which
+# phases and subprocesses overlapped.
+
+import atexit
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+trace_environment_variable = "GIB_TRACE"
+
+active_profiler = None
+
+def describe_command(args):
+    '''Return a short name for the command "args", e.g. "git
+    update-index", for grouping subprocesses in the summary'''
+    if isinstance(args, (str, bytes)):
+        return os.path.basename(os.fsdecode(args).split()[0])
+    args = [ os.fsdecode(a) for a in args ]
+    name = os.path.basename(args[0])
+    if name != "git":
+        return name
+    # Skip git's global options to find the subcommand:
+    i = 1
+    while i < len(args) and args[i].startswith("-"):
+        if args[i] in ("-c", "-C"):
+            i += 1
+        i += 1
+    if i < len(args):
+        name += " " + args[i]
+    return name
+
+class ProcessRecord:
+    '''What is known about one subprocess'''
+
+    def __init__(self, args, pid, start, thread):
+        self.args = args
+        self.pid = pid
+        self.start = start
+        self.end = None
+        self.returncode = None
+        self.thread = thread
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # communicate() counts the bytes itself:
+        self.communicating = False
+
+class CountingStream:
+    '''Wraps a pipe to or from a subprocess, adding the number of bytes
+    (or characters) that pass through it to "record"'''
+
+    def __init__(self, stream, record, attribute):
+        self.stream = stream
+        self.record = record
+        self.attribute = attribute
+
+    def add(self, data):
+        if data and not self.record.communicating:
+            setattr(self.record, self.attribute,
+                    getattr(self.record, self.attribute) + len(data))
+        return data
+
+    def read(self, *args):
+        return self.add(self.stream.read(*args))
+
+    def read1(self, *args):
+        return self.add(self.stream.read1(*args))
+
+    def readline(self, *args):
+        return self.add(self.stream.readline(*args))
+
+    def readinto(self, buffer):
+        n = self.stream.readinto(buffer)
+        self.add(range(n or 0))
+        return n
+
+    def write(self, data):
+        n = self.stream.write(data)
+        self.add(data)
+        return n
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception_information):
+        self.stream.close()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class Profiler:
+    '''Records the phases and subprocesses of this run of gib, and
+    writes them to "trace_filename" at exit'''
+
+    def __init__(self, trace_filename=None):
+        self.trace_filename = trace_filename
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.events = []
+        # The total wall, CPU and children's CPU time of each phase,
+        # by name, and how deeply the first one was nested:
+        self.phases = OrderedDict()
+        self.processes = []
+        self.counters = OrderedDict()
+        self.depth = threading.local()
+
+    def now(self):
+        '''Return the number of microseconds since profiling started'''
+        return (time.perf_counter() - self.origin) * 1e6
+
+    def event(self, event):
+        event.setdefault("pid", os.getpid())
+        event.setdefault("tid", threading.get_ident())
+        with self.lock:
+            self.events.append(event)
+
+    @contextmanager
+    def phase(self, name):
+        depth = getattr(self.depth, "value", 0)
+        self.depth.value = depth + 1
+        with self.lock:
+            totals = self.phases.setdefault(name, [depth, 0, 0, 0])
+        start = self.now()
+        cpu_start = time.process_time()
+        children_start = sum(os.times()[2:4])
+        try:
+            yield
+        finally:
+            self.depth.value = depth
+            wall = (self.now() - start) / 1e6
+            cpu = time.process_time() - cpu_start
+            children = sum(os.times()[2:4]) - children_start
+            self.event({
+                "name": name,
+                "cat": "phase",
+                "ph": "X",
+                "ts": start,
+                "dur": wall * 1e6,
+                "args": {"cpu_seconds": cpu, "children_cpu_seconds": children}
+            })
+            with self.lock:
+                totals[1] += wall
+                totals[2] += cpu
+                totals[3] += children
+
+    def count(self, name, amount):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+            value = self.counters[name]
+        self.event({
+            "name": name,
+            "cat": "counter",
+            "ph": "C",
+            "ts": self.now(),
+            "args": {"value": value}
+        })
+
+    def install(self):
+        '''Wrap subprocess.Popen so that every subprocess is recorded'''
+        profiler = self
+        original_init = subprocess.Popen.__init__
+        original_communicate = subprocess.Popen.communicate
+        original_wait = subprocess.Popen.wait
+        original_poll = subprocess.Popen.poll
+
+        def __init__(popen, *args, **kwargs):
+            original_init(popen, *args, **kwargs)
+            record = ProcessRecord(popen.args, popen.pid, profiler.now(),
+                                   threading.get_ident())
+            popen.gib_profile = record
+            if popen.stdin:
+                popen.stdin = CountingStream(popen.stdin, record, "bytes_in")
+            if popen.stdout:
+                popen.stdout = CountingStream(popen.stdout, record, "bytes_out")
+            with profiler.lock:
+                profiler.processes.append(record)
+
+        def communicate(popen, input=None, timeout=None):
+            record = getattr(popen, "gib_profile", None)
+            if record is None:
+                return original_communicate(popen, input, timeout)
+            record.communicating = True
+            try:
+                output, error = original_communicate(popen, input, timeout)
+            finally:
+                record.communicating = False
+            if popen.stdin and input:
+                record.bytes_in += len(input)
+            if output:
+                record.bytes_out += len(output)
+            return output, error
+
+        def finished(popen):
+            record = getattr(popen, "gib_profile", None)
+            if record and record.end is None and popen.returncode is not None:
+                record.end = profiler.now()
+                record.returncode = popen.returncode
+
+        def wait(popen, timeout=None):
+            result = original_wait(popen, timeout)
+            finished(popen)
+            return result
+
+        def poll(popen):
+            result = original_poll(popen)
+            finished(popen)
+            return result
+
+        subprocess.Popen.__init__ = __init__
+        subprocess.Popen.communicate = communicate
+        subprocess.Popen.wait = wait
+        subprocess.Popen.poll = poll
+
+    def process_events(self):
+        end = self.now()
+        for record in self.processes:
+            args = record.args
+            if not isinstance(args, (str, bytes)):
+                args = [ os.fsdecode(a) for a in args ]
+            yield {
+                "name": describe_command(record.args),
+                "cat": "subprocess",
+                "ph": "X",
+                "ts": record.start,
+                "dur": (record.end if record.end is not None else end)
+                       - record.start,
+                "tid": record.thread,
+                "args": {
+                    "argv": args if isinstance(args, list) else os.fsdecode(args),
+                    "pid": record.pid,
+                    "returncode": record.returncode,
+                    "bytes_in": record.bytes_in,
+                    "bytes_out": record.bytes_out
+                }
+            }
+
+    def write_trace(self):
+        events = self.events + list(self.process_events())
+        with open(self.trace_filename + ".tmp", "w") as f:
+            json.dump({
+                "traceEvents": events,
+                "displayTimeUnit": "ms",
+                "otherData": {"argv": sys.argv, "counters": self.counters}
+            }, f)
+        os.rename(self.trace_filename + ".tmp", self.trace_filename)
+
+    def summary(self):
+        '''Return a table of the time spent in each phase and each kind
+        of subprocess, and the counters'''
+        lines = ["{:<40} {:>9} {:>9} {:>12}".format(
+            "Phase", "Wall", "CPU", "Child CPU")]
+        for name, (depth, wall, cpu, children) in self.phases.items():
+            lines.append("{:<40} {:>8.3f}s {:>8.3f}s {:>11.3f}s".format(
+                "  " * depth + name, wall, cpu, children))
+        by_command = OrderedDict()
+        end = self.now()
+        for record in self.processes:
+            totals = by_command.setdefault(
+                describe_command(record.args), [0, 0, 0, 0, 0])
+            duration = ((record.end if record.end is not None else end)
+                        - record.start) / 1e6
+            totals[0] += 1
+            totals[1] += duration
+            totals[2] = max(totals[2], duration)
+            totals[3] += record.bytes_in
+            totals[4] += record.bytes_out
+        lines.append("")
+        lines.append("{:<32} {:>7} {:>9} {:>9} {:>12} {:>12}".format(
+            "Subprocess", "Count", "Total", "Longest", "Bytes in", "Bytes out"))
+        for name, (n, total, longest, bytes_in, bytes_out) in sorted(
+                by_command.items(), key=lambda t: -t[1][1]):
+            lines.append(
+                "{:<32} {:>7} {:>8.3f}s {:>8.3f}s {:>12} {:>12}".format(
+                    name, n, total, longest, bytes_in, bytes_out))
+        if self.counters:
+            lines.append("")
+            for name, value in self.counters.items():
+                lines.append("{:<40} {:>12}".format(name, value))
+        return "\n".join(lines)
+
+    def finish(self):
+        # Write the trace first, in case standard error has been closed:
+        if self.trace_filename:
+            self.write_trace()
+        print(self.summary(), file=sys.stderr)
+        if self.trace_filename:
+            print("The trace was written to " + self.trace_filename,
+                  file=sys.stderr)
+
+def start(trace_filename=None):
+    '''Start profiling this run, writing the trace to "trace_filename"
+    (if that's not known yet, set the trace_filename of the Profiler
+    that's returned).  The whole run is recorded as the phase "gib",
+    and the results are written at exit.'''
+    global active_profiler
+    active_profiler = Profiler(trace_filename)
+    active_profiler.install()
+    # Any gib that this one runs (e.g. for "commit-all") shouldn't
+    # write to the same file:
+    os.environ.pop(trace_environment_variable, None)
+    whole_run = active_profiler.phase("gib")
+    whole_run.__enter__()
+    def at_exit():
+        whole_run.__exit__(None, None, None)
+        active_profiler.finish()
+    atexit.register(at_exit)
+    return active_profiler
+
+@contextmanager
+def phase(name):
+    '''Record the time spent in the body of the "with" statement as
+    the phase "name", if profiling'''
+    if active_profiler is None:
+        yield
+        return
+    with active_profiler.phase(name):
+        yield
+
+def count(name, amount=1):
+    '''Add "amount" to the counter "name", if profiling'''
+    if active_profiler is not None:
+        active_profiler.count(name, amount)
@@ -0,0 +1,308 @@
+# Replicating a backup repository to another one (e.g. on a second
+# disk) without copying the whole git directory each time.
+#
+# "gib bundle DIRECTORY" writes a set of files to DIRECTORY containing
+# just what is new since the last set written there:
+#
+#   <NAME>.json                - the manifest, listing every ref and
+#                                the files below with their SHA-256
+#   <NAME>-backup.bundle       - an incremental git bundle of the
+#                                backup repository
+#   <NAME>-repositories.bundle - an incremental git bundle of the
+#                                shared repository of the objects of
+#                                nested git repositories (see
+#                                repositorystore.py)
+#
+# ... where NAME is the date and time it was created.  A bundle is left
+# out if there are no new commits in that repository.  The tips of the
+# refs that were bundled are recorded in gib-replication.json in the
+# git directory, under the absolute path of DIRECTORY, and the next set
+# only contains the objects that can't be reached from them.
+#
+# "gib import-bundles DIRECTORY" imports every set in DIRECTORY that
+# the repository hasn't imported yet, oldest first.  Each bundle's
+# checksum is checked and "git bundle verify" checks that the objects
+# it depends on are present before it is unpacked.  The refs are then
+# set to exactly those in the manifest (so refs that were deleted are
+# deleted here too), it is checked that everything they refer to is
+# present, and the mirrors of nested repositories whose refs changed
+# are updated.  The names of the sets that have been imported are
+# recorded in gib-replication.json in the target.
+#
+# "gib replicate DESTINATION" does both at once, with the bundles in a
+# temporary directory in DESTINATION.  In that case, the refs already
+# in DESTINATION are used as the starting point, rather than the
+# recorded tips, so a replica that was restored from elsewhere is
+# still updated correctly.
+
+import hashlib
+import json
+import os
+import shutil
+from subprocess import check_call, check_output, Popen, PIPE, DEVNULL
+import tempfile
+import time
+
+from plumbing import lines
+from repositorystore import RepositoryStore
+
+state_leafname = 'gib-replication.json'
+manifest_format = 1
+
+def sha256_of_file(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def git(git_directory, rest_of_command):
+    return ["git", "--git-dir=" + git_directory] + rest_of_command
+
+def read_refs(git_directory):
+    '''Return a dictionary mapping each ref in "git_directory" to the
+    object name it points to'''
+    result = {}
+    for line in lines(git(git_directory, [
+            "for-each-ref", "--format=%(objectname) %(refname)"])):
+        object_name, _, ref = line.partition(' ')
+        if ref:
+            result[ref] = object_name
+    return result
+
+def existing_objects(git_directory, object_names):
+    '''Return the subset of "object_names" that are in "git_directory"'''
+    if not object_names:
+        return set()
+    p = Popen(git(git_directory, ["cat-file", "--batch-check"]),
+              stdin=PIPE, stdout=PIPE)
+    output = p.communicate(
+        "".join(o + "\n" for o in object_names).encode()
+    )[0].decode()
+    return set(line.split()[0] for line in output.splitlines()
+               if not line.endswith(" missing"))
+
+class Replica:
+    '''A backup repository in "git_directory" that is replicated to, or
+    from, other repositories'''
+
+    def __init__(self, git_directory):
+        self.git_directory = git_directory
+        self.store = RepositoryStore(git_directory)
+        self.state_filename = os.path.join(git_directory, state_leafname)
+
+    def load_state(self):
+        try:
+            with open(self.state_filename) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def save_state(self, state):
+        with open(self.state_filename + ".tmp", "w") as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+        os.rename(self.state_filename + ".tmp", self.state_filename)
+
+    def repositories(self):
+        '''Return a dictionary mapping the name used in the manifest of
+        each repository that is replicated to its git directory'''
+        return {"backup": self.git_directory,
+                "repositories": self.store.directory}
+
+    def initialize(self):
+        '''Create the repositories that don't exist yet'''
+        if not os.path.isdir(os.path.join(self.git_directory, "objects")):
+            check_call(["git", "init", "--bare", "--quiet", self.git_directory])
+            # gib always sets the work tree when using the repository:
+            check_call(git(self.git_directory, ["config", "core.bare", "false"]))
+            check_call(git(self.git_directory, ["config", "gc.auto", "0"]))
+        self.store.create()
+
+    def tips(self):
+        '''Return a dictionary mapping the name of each repository to a
+        list of the object names its refs point to'''
+        return dict(
+            (name, sorted(set(read_refs(directory).values()))
+             if os.path.isdir(directory) else [])
+            for name, directory in self.repositories().items()
+        )
+
+    def write_bundles(self, output_directory, basis, report):
+        '''Write a manifest and bundles of everything that can't be
+        reached from "basis" (as returned by tips()) to
+        "output_directory".  Returns a tuple of the name of the manifest
+        and the tips of what was bundled.'''
+        now = time.time()
+        name = time.strftime("%Y%m%dT%H%M%S", time.localtime(now)) + \
+            ".{:06d}".format(int(now % 1 * 1000000))
+        manifest = {"format": manifest_format, "name": name,
+                    "repositories": {}}
+        bundled = {}
+        for repository, directory in sorted(self.repositories().items()):
+            refs = read_refs(directory) if os.path.isdir(directory) else {}
+            bundled[repository] = sorted(set(refs.values()))
+            entry = {"refs": refs, "bundle": None}
+            manifest["repositories"][repository] = entry
+            if not refs:
+                continue
+            # Only exclude the objects that this repository has:
+            excluded = existing_objects(directory, basis.get(repository, []))
+            revisions = "".join(r + "\n" for r in sorted(refs)) + \
+                "".join("^" + o + "\n" for o in sorted(excluded))
+            new_commit = check_output(
+                git(directory, ["rev-list", "-n", "1", "--stdin"]),
+                input=revisions.encode()
+            ).strip()
+            if not new_commit:
+                report("{}: nothing new".format(repository))
+                continue
+            leafname = "{}-{}.bundle".format(name, repository)
+            filename = os.path.join(output_directory, leafname)
+            p = Popen(git(directory, ["bundle", "create", "--quiet",
+                                      filename, "--stdin"]),
+                      stdin=PIPE)
+            p.communicate(revisions.encode())
+            if p.returncode != 0:
+                raise Exception("Creating the bundle {} failed".format(filename))
+            entry["bundle"] = leafname
+            entry["sha256"] = sha256_of_file(filename)
+            report("{}: wrote {} ({} bytes)".format(
+                repository, leafname, os.path.getsize(filename)))
+        manifest["mirrors"] = [
+            {"branch": branch, "path": path, "head": head}
+            for branch, path, head in self.store.mirrors()
+        ] if self.store.exists() else []
+        manifest_filename = os.path.join(output_directory, name + ".json")
+        with open(manifest_filename + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.rename(manifest_filename + ".tmp", manifest_filename)
+        return name, bundled
+
+    def bundle(self, output_directory, report):
+        '''Write the bundles of what's new since the last bundles
+        written to "output_directory"'''
+        key = os.path.abspath(output_directory)
+        state = self.load_state()
+        basis = state.get("bundled", {}).get(key, {})
+        name, bundled = self.write_bundles(output_directory, basis, report)
+        state.setdefault("bundled", {})[key] = bundled
+        self.save_state(state)
+        return name
+
+    def manifests(self, directory):
+        '''Return the names of the sets of bundles in "directory" that
+        haven't been imported yet, oldest first'''
+        imported = set(self.load_state().get("imported", []))
+        names = []
+        for leafname in os.listdir(directory):
+            if leafname.endswith(".json"):
+                name = leafname[:-len(".json")]
+                if name not in imported:
+                    names.append(name)
+        return sorted(names)
+
+    def import_bundles(self, directory, report):
+        '''Import every set of bundles in "directory" that hasn't been
+        imported yet.  Returns the number of sets imported.'''
+        self.initialize()
+        names = self.manifests(directory)
+        for name in names:
+            with open(os.path.join(directory, name + ".json")) as f:
+                manifest = json.load(f)
+            if manifest.get("format") != manifest_format:
+                raise Exception("{} has an unknown format".format(name))
+            report("Importing " + name)
+            self.import_manifest(directory, manifest, report)
+            state = self.load_state()
+            state.setdefault("imported", []).append(name)
+            self.save_state(state)
+        return len(names)
+
+    def import_manifest(self, directory, manifest, report):
+        repositories = self.repositories()
+        old_store_refs = read_refs(self.store.directory)
+        for repository, entry in sorted(manifest["repositories"].items()):
+            target = repositories[repository]
+            old_refs = read_refs(target)
+            if entry["bundle"]:
+                filename = os.path.join(directory, entry["bundle"])
+                if sha256_of_file(filename) != entry["sha256"]:
+                    raise Exception(
+                        "The checksum of {} is wrong".format(filename))
+                # This checks that the objects the bundle depends on
+                # are present:
+                p = Popen(git(target, ["bundle", "verify", filename]),
+                          stdout=DEVNULL, stderr=PIPE)
+                error = p.communicate()[1].decode()
+                if p.returncode != 0:
+                    raise Exception("{} could not be verified: {}".format(
+                        filename, error.strip()))
+                check_call(git(target, ["bundle", "unbundle", filename]),
+                           stdout=DEVNULL)
+            new_refs = entry["refs"]
+            # Check that everything the new refs need is present before
+            # changing any of them:
+            revisions = "".join(
+                o + "\n" for o in sorted(set(new_refs.values()))
+            ) + "".join(
+                "^" + o + "\n" for o in sorted(set(old_refs.values()))
+            )
+            p = Popen(git(target, ["rev-list", "--objects", "--quiet",
+                                   "--stdin"]),
+                      stdin=PIPE)
+            p.communicate(revisions.encode())
+            if p.returncode != 0:
+                raise Exception(
+                    "Objects are missing after importing into {}".format(
+                        target))
+            commands = [ "update {} {}\n".format(ref, object_name)
+                         for ref, object_name in sorted(new_refs.items())
+                         if old_refs.get(ref) != object_name ]
+            commands += [ "delete {}\n".format(ref)
+                          for ref in sorted(old_refs) if ref not in new_refs ]
+            if commands:
+                p = Popen(git(target, ["update-ref", "--stdin"]), stdin=PIPE)
+                p.communicate("".join(commands).encode())
+                if p.returncode != 0:
+                    raise Exception("Updating the refs in {} failed".format(
+                        target))
+            report("{}: {} refs changed".format(repository, len(commands)))
+        # Only the mirrors whose refs or HEAD changed need updating:
+        new_store_refs = read_refs(self.store.directory)
+        for mirror in manifest["mirrors"]:
+            branch, path, head = mirror["branch"], mirror["path"], mirror["head"]
+            namespace = self.store.namespace(branch, path)
+            mirror_directory = self.store.mirror_directory(branch, path)
+            changed = any(
+                old_store_refs.get(ref) != new_store_refs.get(ref)
+                for ref in set(old_store_refs) | set(new_store_refs)
+                if ref.startswith(namespace)
+            )
+            try:
+                with open(os.path.join(mirror_directory, "HEAD")) as f:
+                    changed = changed or f.read().strip() != head
+            except FileNotFoundError:
+                changed = True
+            if changed or not self.store.is_mirror(mirror_directory):
+                self.store.update_mirror(branch, path, head)
+
+    def replicate(self, destination, report):
+        '''Bring the backup repository "destination" up to date with
+        this one'''
+        target = Replica(destination)
+        target.initialize()
+        temporary_directory = tempfile.mkdtemp(prefix="gib-bundles-",
+                                               dir=destination)
+        try:
+            name, bundled = self.write_bundles(
+                temporary_directory,
+                target.tips(),
+                report
+            )
+            target.import_bundles(temporary_directory, report)
+        finally:
+            shutil.rmtree(temporary_directory)
+        state = self.load_state()
+        state.setdefault("replicated", {})[os.path.abspath(destination)] = \
+            bundled
+        self.save_state(state)
@@ -0,0 +1,337 @@
+# The git repositories found in the directories that are backed up are
+# not copied file by file.  Instead, their objects are fetched into a
+# single bare repository that all the branches share,
+# git-repositories/objects.git in the git directory, so an object that
+# is in several of them (e.g. the same project checked out on several
+# computers, or twice on one) is only stored once, and each backup
+# only transfers the objects that are new.  The refs of the repository
+# at PATH in the directory backed up to BRANCH are kept under:
+#
+#   refs/gib/<BRANCH>/<PATH>/
+#
+# ... with any character in BRANCH and PATH other than a letter, digit,
+# "-" or "_" (including "/") encoded as %XX, so that every repository
+# has its own namespace.  If its HEAD is detached, that commit is kept
+# as refs/gib-heads/<BRANCH>/<PATH>.
+#
+# So that the URLs in .gitmodules (and so "gib restore") work as they
+# did when the repositories were copied with rsync, there is still a
+# repository for each one at:
+#
+#   git-repositories/<BRANCH>/<PATH>/.git
+#
+# ... but that is now a small bare repository with the same refs and
+# HEAD as the original, which borrows all its objects from the shared
+# repository through a relative path in objects/info/alternates.  (So
+# that these don't collide with the shared repository, gitsetup.py
+# rejects a BRANCH whose first component is "objects.git".)  Any
+# old copy made by rsync is moved out of the way first, to:
+#
+#   git-repositories-old/<BRANCH>/<PATH>/.git
+#
+# ... and nothing in it is deleted, since it may be the only backup of
+# something that the original no longer has (e.g. its reflogs).
+#
+# Fetching only copies the objects and refs, so the files in each
+# repository's git directory that would otherwise be lost (its config,
+# hooks and the files in info/) are committed to:
+#
+#   refs/gib-settings/<BRANCH>/<PATH>
+#
+# ... in the shared repository whenever they change, with the previous
+# version as the parent.  To see them, use e.g.:
+#
+#   git --git-dir=.git/git-repositories/objects.git show \
+#       refs/gib-settings/master/src%2Fgib:config
+
+import os
+import stat
+from subprocess import check_call, check_output, Popen, PIPE
+import tempfile
+from urllib.parse import unquote_to_bytes
+
+repositories_leafname = 'git-repositories'
+old_repositories_leafname = 'git-repositories-old'
+store_leafname = 'objects.git'
+
+# The parts of a repository's git directory, other than its objects
+# and refs, that are recorded with it:
+settings_files = ['config', 'description']
+settings_directories = ['hooks', 'info']
+
+def encode_ref_component(s):
+    '''Encode the string "s" so that it can be used as a single
+    component of a ref name'''
+    return ''.join(
+        chr(c) if chr(c).isalnum() and c < 0x80 or c in b'-_'
+        else '%{:02X}'.format(c)
+        for c in os.fsencode(s)
+    )
+
+def decode_ref_component(s):
+    '''The inverse of encode_ref_component'''
+    return os.fsdecode(unquote_to_bytes(s))
+
+class RepositoryStore:
+    '''The shared store of the objects of nested git repositories for
+    the backup repository in "git_directory"'''
+
+    def __init__(self, git_directory):
+        self.repositories_directory = os.path.join(
+            git_directory,
+            repositories_leafname
+        )
+        self.old_repositories_directory = os.path.join(
+            git_directory,
+            old_repositories_leafname
+        )
+        self.directory = os.path.join(
+            self.repositories_directory,
+            store_leafname
+        )
+
+    def git(self, git_directory, rest_of_command):
+        return ["git", "--git-dir=" + git_directory] + rest_of_command
+
+    def exists(self):
+        return os.path.isdir(os.path.join(self.directory, "objects"))
+
+    def create(self):
+        '''Create the shared repository, if it doesn't exist yet.  This
+        should be called with the backup repository's lock held.'''
+        if self.exists():
+            return
+        check_call(["git", "init", "--bare", "--quiet", self.directory])
+        # As in the backup repository, "gib maintain" does this:
+        check_call(self.git(self.directory, ["config", "gc.auto", "0"]))
+
+    def namespace(self, branch, path):
+        return "refs/gib/{}/{}/".format(
+            encode_ref_component(branch),
+            encode_ref_component(path)
+        )
+
+    def head_ref(self, branch, path):
+        return "refs/gib-heads/{}/{}".format(
+            encode_ref_component(branch),
+            encode_ref_component(path)
+        )
+
+    def settings_ref(self, branch, path):
+        return "refs/gib-settings/{}/{}".format(
+            encode_ref_component(branch),
+            encode_ref_component(path)
+        )
+
+    def mirror_directory(self, branch, path):
+        '''Return the path of the repository that .gitmodules refers to
+        for the repository at "path" in the directory backed up to
+        "branch"'''
+        return os.path.join(
+            self.repositories_directory,
+            branch,
+            path.lstrip("/"),
+            ".git"
+        )
+
+    def is_mirror(self, mirror):
+        try:
+            with open(os.path.join(mirror, "objects", "info", "alternates")) as f:
+                alternates = f.read().splitlines()
+        except FileNotFoundError:
+            return False
+        return self.relative_objects_directory(mirror) in alternates
+
+    def relative_objects_directory(self, mirror):
+        return os.path.relpath(
+            os.path.join(self.directory, "objects"),
+            os.path.join(mirror, "objects")
+        )
+
+    def old_copy_directory(self, branch, path):
+        '''Return a path that doesn't exist yet to move an old copy of
+        the repository at "path" in the directory backed up to "branch"
+        to'''
+        result = os.path.join(
+            self.old_repositories_directory,
+            branch,
+            path.lstrip("/"),
+            ".git"
+        )
+        suffix = 1
+        while os.path.lexists(result):
+            suffix += 1
+            result = os.path.join(
+                self.old_repositories_directory,
+                branch,
+                path.lstrip("/"),
+                ".git.{}".format(suffix)
+            )
+        return result
+
+    def create_mirror(self, branch, path, mirror):
+        if os.path.lexists(mirror):
+            # This is a copy of the repository made by rsync, which may
+            # have things that the original no longer does, so keep
+            # all of it:
+            old_copy = self.old_copy_directory(branch, path)
+            os.makedirs(os.path.dirname(old_copy), exist_ok=True)
+            os.rename(mirror, old_copy)
+        check_call(["git", "init", "--bare", "--quiet", mirror])
+        check_call(self.git(mirror, ["config", "gc.auto", "0"]))
+        with open(os.path.join(mirror, "objects", "info", "alternates"), "w") as f:
+            f.write(self.relative_objects_directory(mirror) + "\n")
+
+    def back_up(self, branch, path, source):
+        '''Fetch the objects and refs of the repository "source" (its
+        .git directory), which is at "path" in the directory backed up
+        to "branch", and update its mirror to match.  Returns the
+        mirror's path.'''
+        mirror = self.mirror_directory(branch, path)
+        if not self.is_mirror(mirror):
+            self.create_mirror(branch, path, mirror)
+        namespace = self.namespace(branch, path)
+        detached_head = None
+        p = Popen(self.git(source, ["symbolic-ref", "-q", "HEAD"]),
+                  stdout=PIPE)
+        output = p.communicate()[0].decode().strip()
+        if p.returncode == 0:
+            head = "ref: " + output
+        else:
+            detached_head = check_output(
+                self.git(source, ["rev-parse", "--verify", "HEAD"])
+            ).decode().strip()
+            head = detached_head
+        refspecs = ["+refs/*:" + namespace + "*"]
+        head_ref = self.head_ref(branch, path)
+        if detached_head:
+            refspecs.append("+HEAD:" + head_ref)
+        check_call(self.git(self.directory, [
+            "fetch", "--quiet", "--prune", "--no-tags", source
+        ] + refspecs))
+        if not detached_head:
+            check_call(self.git(self.directory, [
+                "update-ref", "-d", head_ref
+            ]))
+        self.record_settings(branch, path, source)
+        self.update_mirror(branch, path, head)
+        return mirror
+
+    def settings_paths(self, source):
+        '''Generate the path, relative to the git directory "source", of
+        each of its settings_files and the files in its
+        settings_directories (apart from git's sample hooks)'''
+        for leafname in settings_files:
+            if os.path.isfile(os.path.join(source, leafname)):
+                yield leafname
+        for directory in settings_directories:
+            top = os.path.join(source, directory)
+            for root, directories, files in os.walk(top):
+                directories.sort()
+                for f in sorted(files):
+                    relative = os.path.relpath(os.path.join(root, f), source)
+                    if directory == 'hooks' and f.endswith('.sample'):
+                        continue
+                    if os.path.isfile(os.path.join(source, relative)):
+                        yield relative
+
+    def record_settings(self, branch, path, source):
+        '''Commit the settings of the repository "source" (its config,
+        hooks and info/) to its settings_ref in the shared repository,
+        if they have changed since they were last recorded'''
+        relative_paths = list(self.settings_paths(source))
+        p = Popen(self.git(self.directory, [
+            "hash-object", "-w", "--stdin-paths"
+        ]), stdin=PIPE, stdout=PIPE)
+        output = p.communicate(b''.join(
+            os.fsencode(os.path.join(source, r)) + b'\n'
+            for r in relative_paths
+        ))[0].decode()
+        if p.returncode != 0:
+            raise Exception("Reading the settings of {} failed".format(source))
+        index_info = b''
+        for relative, object_name in zip(relative_paths, output.split()):
+            mode = os.stat(os.path.join(source, relative)).st_mode
+            index_info += "{} {}\t".format(
+                "100755" if mode & stat.S_IXUSR else "100644",
+                object_name
+            ).encode() + os.fsencode(relative) + b'\0'
+        # Build the tree in a temporary index, so that nothing else is
+        # affected:
+        handle, index_file = tempfile.mkstemp(prefix="gib-settings-index-",
+                                              dir=self.directory)
+        os.close(handle)
+        os.remove(index_file)
+        try:
+            environment = dict(os.environ, GIT_INDEX_FILE=index_file)
+            p = Popen(self.git(self.directory, ["update-index", "--add",
+                                                "-z", "--index-info"]),
+                      stdin=PIPE, env=environment)
+            p.communicate(index_info)
+            if p.returncode != 0:
+                raise Exception("Recording the settings of {} failed".format(
+                    source))
+            tree = check_output(self.git(self.directory, ["write-tree"]),
+                                env=environment).decode().strip()
+        finally:
+            if os.path.exists(index_file):
+                os.remove(index_file)
+        ref = self.settings_ref(branch, path)
+        p = Popen(self.git(self.directory, [
+            "rev-parse", "--verify", "--quiet", ref
+        ]), stdout=PIPE)
+        parent = p.communicate()[0].decode().strip() or None
+        if parent:
+            parent_tree = check_output(self.git(self.directory, [
+                "rev-parse", "--verify", parent + "^{tree}"
+            ])).decode().strip()
+            if parent_tree == tree:
+                return
+        command = ["commit-tree", tree, "-m",
+                   "Settings of {} in {}".format(path, branch)]
+        if parent:
+            command += ["-p", parent]
+        commit = check_output(self.git(self.directory, command)).decode().strip()
+        check_call(self.git(self.directory, ["update-ref", ref, commit]))
+
+    def update_mirror(self, branch, path, head):
+        '''Make the mirror of the repository at "path" in the directory
+        backed up to "branch" have the refs in its namespace in the
+        shared repository, and the HEAD "head" (either "ref: " and the
+        name of a branch, or an object name)'''
+        mirror = self.mirror_directory(branch, path)
+        if not self.is_mirror(mirror):
+            self.create_mirror(branch, path, mirror)
+        # Every object is already in the shared repository, so this
+        # just copies the refs:
+        check_call(self.git(mirror, [
+            "fetch", "--quiet", "--prune", "--no-tags", self.directory,
+            "+" + self.namespace(branch, path) + "*:refs/*"
+        ]))
+        if head.startswith("ref: "):
+            check_call(self.git(mirror, ["symbolic-ref", "HEAD", head[5:]]))
+        else:
+            check_call(self.git(mirror, ["update-ref", "--no-deref", "HEAD", head]))
+
+    def mirrors(self):
+        '''Return a list of (branch, path, head) for every repository
+        that has refs in the shared repository, where "head" is as for
+        update_mirror'''
+        output = check_output(self.git(self.directory, [
+            "for-each-ref", "--format=%(refname)", "refs/gib/", "refs/gib-heads/"
+        ])).decode()
+        namespaces = set()
+        for ref in output.splitlines():
+            components = ref.split("/")
+            namespaces.add((decode_ref_component(components[2]),
+                            decode_ref_component(components[3])))
+        result = []
+        for branch, path in sorted(namespaces):
+            mirror = self.mirror_directory(branch, path)
+            try:
+                with open(os.path.join(mirror, "HEAD")) as f:
+                    head = f.read().strip()
+            except FileNotFoundError:
+                continue
+            result.append((branch, path, head))
+        return result
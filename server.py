@@ -0,0 +1,187 @@
+# "gib serve" keeps a process running that answers requests to show
+# files, list trees and extract subtrees from a backup repository, over
+# the Unix socket gib.sock in the git directory.  It keeps a warm "git
+# cat-file --batch" process, so each request only costs a round trip on
+# the socket rather than starting gib and several git processes.  When
+# the socket exists, "gib show", "gib ls" and "gib extract" send their
+# request to it, and otherwise they run as usual.
+#
+# Each request is a single line of JSON, e.g.:
+#
+#   {"command": "show", "ref": "refs/heads/master", "path": "notes.txt"}
+#
+# ... and each response is a line of JSON, either:
+#
+#   {"ok": true, "length": <N>}    followed by N bytes of output, or
+#   {"ok": false, "error": <MESSAGE>}
+#
+# Any number of requests may be sent on one connection.  Paths are
+# encoded with os.fsdecode, so any bytes can be represented.
+
+from io import BytesIO
+import json
+import os
+import socket
+import socketserver
+import threading
+
+from chunking import chunked_list_filename, parse_chunked_list, reassemble
+from extraction import Extraction
+from githelpers import CatFileBatch, quote_path, tree_mode_to_type
+
+socket_leafname = 'gib.sock'
+
+def socket_filename(git_directory):
+    return os.path.join(git_directory, socket_leafname)
+
+class RequestError(Exception):
+    pass
+
+class GibServer:
+    '''Serves requests for the repository in "git_directory", accessed
+    with "git_command", using "jobs" threads for extracting'''
+
+    def __init__(self, git_directory, git_command, jobs=1):
+        self.git_directory = git_directory
+        self.git_command = git_command
+        self.jobs = jobs
+        self.cat_file = CatFileBatch(git_command)
+        self.cat_file_lock = threading.Lock()
+        # The set of chunked paths in each tree that has been looked at:
+        self.chunked_cache = {}
+
+    def read_object(self, name):
+        with self.cat_file_lock:
+            return self.cat_file.read_object(name)
+
+    def chunked_paths(self, ref):
+        tree = self.read_object(ref + "^{tree}")
+        if not tree:
+            raise RequestError("'{}' could not be found".format(ref))
+        if tree[0] not in self.chunked_cache:
+            result = self.read_object(tree[0] + ":" + chunked_list_filename)
+            self.chunked_cache[tree[0]] = \
+                parse_chunked_list(result[2]) if result else set()
+        return self.chunked_cache[tree[0]]
+
+    def show(self, request):
+        ref, path = request["ref"], os.fsencode(request["path"])
+        result = self.read_object(ref.encode() + b":" + path)
+        if not result or result[1] != "blob":
+            raise RequestError("'{}' was not found in '{}'".format(
+                request["path"], ref))
+        if path not in self.chunked_paths(ref):
+            return result[2]
+        output = BytesIO()
+        with self.cat_file_lock:
+            reassemble(self.cat_file, result[2], output)
+        return output.getvalue()
+
+    def ls(self, request):
+        ref, path = request["ref"], request.get("path", "")
+        name = ref + ":" + path.strip("/")
+        with self.cat_file_lock:
+            entries = self.cat_file.read_tree(name)
+        if entries is None:
+            raise RequestError("'{}' was not a tree".format(name))
+        return b"".join(
+            "{:06o} {} {}\t".format(
+                mode, tree_mode_to_type(mode), object_name
+            ).encode() + quote_path(entry_name) + b"\n"
+            for mode, entry_name, object_name in entries
+        )
+
+    def extract(self, request):
+        ref, path = request["ref"], request["path"]
+        destination = request["destination"]
+        if not os.path.isdir(destination):
+            raise RequestError(
+                "The destination directory ({}) does not exist".format(
+                    destination))
+        messages = []
+        extraction = Extraction(
+            self.git_command,
+            ref,
+            os.fsencode(path),
+            os.fsencode(os.path.join(destination, path)),
+            jobs=self.jobs,
+            chunked=self.chunked_paths(ref)
+        )
+        try:
+            extraction.run(report=messages.append)
+        except Exception as e:
+            raise RequestError("Extracting {} failed: {}".format(path, e))
+        return "".join(m + "\n" for m in messages).encode()
+
+    def handle(self, request):
+        '''Return the output for "request", a dictionary, or raise a
+        RequestError'''
+        handlers = {"show": self.show, "ls": self.ls, "extract": self.extract}
+        command = request.get("command")
+        if command not in handlers:
+            raise RequestError("Unknown command '{}'".format(command))
+        try:
+            return handlers[command](request)
+        except KeyError as e:
+            raise RequestError("The request had no {}".format(e))
+
+    def serve_forever(self, report=None):
+        filename = socket_filename(self.git_directory)
+        if request(self.git_directory, None) is not None:
+            raise RequestError("A server is already running on " + filename)
+        if os.path.exists(filename):
+            os.remove(filename)
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        data = server.handle(json.loads(line.decode()))
+                        header = {"ok": True, "length": len(data)}
+                    except (RequestError, ValueError) as e:
+                        data = b""
+                        header = {"ok": False, "error": str(e)}
+                    try:
+                        self.wfile.write(
+                            json.dumps(header).encode() + b"\n" + data
+                        )
+                        self.wfile.flush()
+                    except (BrokenPipeError, ConnectionResetError):
+                        # The client has gone away.
+                        return
+
+        class Server(socketserver.ThreadingUnixStreamServer):
+            daemon_threads = True
+
+        with Server(filename, Handler) as s:
+            if report:
+                report("Listening on " + filename)
+            try:
+                s.serve_forever()
+            finally:
+                os.remove(filename)
+
+def request(git_directory, message):
+    '''Send the request "message" (a dictionary) to the server for the
+    repository in "git_directory", and return a tuple of (True, output)
+    or (False, error message).  If there's no server running, return
+    None.  If "message" is None, just check whether there is one.'''
+    filename = socket_filename(git_directory)
+    if not os.path.exists(filename):
+        return None
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(filename)
+    except OSError:
+        s.close()
+        return None
+    with s, s.makefile('rwb') as f:
+        if message is None:
+            return (True, b"")
+        f.write(json.dumps(message).encode() + b"\n")
+        f.flush()
+        header = json.loads(f.readline().decode())
+        if not header["ok"]:
+            return (False, header["error"])
+        return (True, f.read(header["length"]))
@@ -0,0 +1,87 @@
+# A stat snapshot records the inode, size, modification time and
+# change time of every file that was committed from the directory to
+# backup.  By comparing a fresh scan of the directory against the
+# snapshot from the previous commit, "gib commit" can find the files
+# that have been added or modified in a single pass, and only pass
+# those paths to git.  Deleted files are those in the index that the
+# scan didn't find.
+#
+# Snapshots are kept in the git directory as gib-snapshots/<branch>,
+# since each branch corresponds to a different directory to back up.
+
+import marshal
+import os
+
+from general import mkdir_p
+
+def stat_entry(s):
+    '''Return the tuple recorded in a snapshot for the stat result "s"'''
+    return (s.st_ino, s.st_size, s.st_mtime_ns, s.st_ctime_ns)
+
+class StatSnapshot:
+    '''A mapping from each path (bytes, relative to the directory to
+    backup) to a tuple of (inode, size, mtime, ctime), where the times
+    are in nanoseconds.'''
+
+    def __init__(self, entries=None):
+        self.entries = entries if entries is not None else {}
+
+    @staticmethod
+    def filename(git_directory, branch):
+        return os.path.join(git_directory, 'gib-snapshots', branch)
+
+    @staticmethod
+    def load(filename):
+        '''Return the snapshot saved in "filename", or None if there is
+        no such snapshot or it can't be read.'''
+        try:
+            with open(filename, 'rb') as f:
+                return StatSnapshot(marshal.load(f))
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def save(self, filename):
+        mkdir_p(os.path.dirname(filename))
+        with open(filename + '.tmp', 'wb') as f:
+            marshal.dump(self.entries, f)
+        os.rename(filename + '.tmp', filename)
+
+    @staticmethod
+    def remove(filename):
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+    def add(self, path, s):
+        '''Record the stat result "s" for "path"'''
+        self.entries[path] = stat_entry(s)
+
+    def is_unchanged(self, path):
+        '''Return True if "path" is in this snapshot and its stat
+        information is still the same'''
+        recorded = self.entries.get(path)
+        if recorded is None:
+            return False
+        try:
+            s = os.lstat(path)
+        except OSError:
+            return False
+        return recorded == stat_entry(s)
+
+    def changed_paths(self, previous):
+        '''Return a list of the paths in this snapshot that are new or
+        have different stat information in the snapshot "previous"
+        (which may be None, in which case every path is returned)'''
+        if previous is None:
+            return list(self.entries)
+        old = previous.entries
+        return [ p for p, s in self.entries.items() if old.get(p) != s ]
+
+    def missing_paths(self, tracked_paths):
+        '''Return a list of the paths in "tracked_paths" (those in the
+        index) that are not in this snapshot and no longer exist at
+        all.  (Paths that still exist but aren't scanned, such as nested
+        git repositories, remain in the index.)'''
+        return [ p for p in tracked_paths
+                 if p not in self.entries and not os.path.lexists(p) ]
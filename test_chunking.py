@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+# Tests for the content-defined chunking in chunking.py.  Run them
+# with:
+#
+#   python3 -m unittest test_chunking
+
+import io
+import random
+import unittest
+
+from chunking import (
+    split_into_chunks, minimum_chunk_size, maximum_chunk_size
+)
+
+megabyte = 1024 * 1024
+
+def chunks_of(data):
+    return list(split_into_chunks(io.BytesIO(data)))
+
+def sparse_bytes(seed, n):
+    '''Return "n" bytes that are zero apart from a pseudo-random byte
+    every 16 bytes, like much of a disk image'''
+    data = bytearray(n)
+    data[::16] = random.Random(seed).randbytes(len(range(0, n, 16)))
+    return bytes(data)
+
+class ChunkingTestCase(unittest.TestCase):
+
+    def test_chunks_reassemble_to_the_file(self):
+        data = random.Random(1).randbytes(6 * megabyte)
+        chunks = chunks_of(data)
+        self.assertEqual(b''.join(chunks), data)
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), minimum_chunk_size)
+            self.assertLessEqual(len(chunk), maximum_chunk_size)
+
+    def test_sparse_data_has_boundaries(self):
+        chunks = chunks_of(sparse_bytes(2, 8 * megabyte))
+        self.assertTrue(any(len(c) < maximum_chunk_size for c in chunks[:-1]))
+
+    def test_insertion_into_zero_filled_file(self):
+        data = bytes(8 * megabyte) + sparse_bytes(3, 8 * megabyte) + \
+            bytes(8 * megabyte)
+        position = megabyte
+        changed = data[:position] + b'inserted' * 16 + data[position:]
+        old_chunks = set(chunks_of(data))
+        new_chunks = chunks_of(changed)
+        new_bytes = sum(len(c) for c in new_chunks if c not in old_chunks)
+        # Only the chunk with the insertion in it, and the one that runs
+        # up to the first boundary in the data after the zeros, should
+        # be new:
+        self.assertLessEqual(new_bytes, 2 * maximum_chunk_size)
+
+if __name__ == '__main__':
+    unittest.main()
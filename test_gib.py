@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+# Tests that run gib itself against a throwaway directory and
+# repository.  Run them with:
+#
+#   python3 -m unittest test_gib
+
+import os
+import shutil
+from subprocess import run, check_output, PIPE, DEVNULL
+import sys
+import tempfile
+import unittest
+
+from snapshot import StatSnapshot
+
+gib_directory = os.path.dirname(os.path.abspath(__file__))
+
+class GibTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="gib-test-")
+        self.home = os.path.join(self.directory,"home")
+        self.repository = os.path.join(self.directory,"backup.git")
+        os.mkdir(self.home)
+        os.mkdir(self.repository)
+        self.environment = dict(os.environ)
+        self.environment.update({
+            "HOME": self.directory,
+            "XDG_CONFIG_HOME": os.path.join(self.directory,"config"),
+            "GIT_AUTHOR_NAME": "gib test",
+            "GIT_AUTHOR_EMAIL": "gib-test@example.org",
+            "GIT_COMMITTER_NAME": "gib test",
+            "GIT_COMMITTER_EMAIL": "gib-test@example.org"
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def gib(self, rest_of_command, input=b"", home=None):
+        '''Run gib with "rest_of_command" for the directory "home" (by
+        default self.home), failing the test if it fails'''
+        command = [sys.executable,os.path.join(gib_directory,"gib"),
+                   "-d",home or self.home,"-g",self.repository] + \
+            rest_of_command
+        result = run(command,env=self.environment,input=input,
+                     stdout=PIPE,stderr=PIPE)
+        self.assertEqual(result.returncode,0,result.stderr.decode())
+        return result.stdout
+
+    def git(self, rest_of_command, cwd=None):
+        return check_output(["git"] + rest_of_command,cwd=cwd,
+                            env=self.environment,stderr=DEVNULL)
+
+    def write(self, path, contents):
+        path = os.path.join(self.home,path)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        with open(path,"w") as fp:
+            fp.write(contents)
+
+    def restore(self):
+        self.gib(["restore"],input=b"Yes, I understand.\n")
+
+    def test_commit_after_restoring_nested_repository(self):
+        project = os.path.join(self.home,"project")
+        self.write("project/file.txt","one\n")
+        self.git(["init","-q"],cwd=project)
+        self.git(["add","file.txt"],cwd=project)
+        self.git(["commit","-q","-m","First"],cwd=project)
+        self.gib(["init"])
+        self.gib(["commit"])
+        shutil.rmtree(project)
+        self.restore()
+        # "git submodule update" leaves a gitfile rather than a directory:
+        self.assertTrue(os.path.isfile(os.path.join(project,".git")))
+        self.write("project/file.txt","two\n")
+        self.git(["commit","-q","-a","-m","Second"],cwd=project)
+        self.gib(["commit"])
+        self.assertEqual(
+            self.git(["--git-dir=" + self.repository,"rev-parse","master:project"]),
+            self.git(["rev-parse","HEAD"],cwd=project)
+        )
+
+    def test_unstage_submodule_when_head_is_another_branch(self):
+        project = os.path.join(self.home,"project")
+        self.write("project/file.txt","one\n")
+        self.git(["init","-q"],cwd=project)
+        self.git(["add","file.txt"],cwd=project)
+        self.git(["commit","-q","-m","First"],cwd=project)
+        self.gib(["-b","b1","init"])
+        self.gib(["-b","b1","commit"])
+        other_home = os.path.join(self.directory,"other")
+        os.mkdir(other_home)
+        self.gib(["-b","b2","init"],home=other_home)
+        self.gib(["-b","b2","commit"],home=other_home)
+        # Replace the nested repository with a file:
+        shutil.rmtree(project)
+        self.write("project","now a file\n")
+        self.gib(["-b","b1","commit"])
+        self.assertEqual(
+            self.git(["--git-dir=" + self.repository,"cat-file","-t","b1:project"]),
+            b"blob\n"
+        )
+
+    def test_delete_file_missing_from_snapshot(self):
+        self.write("kept.txt","kept\n")
+        self.write("deleted.txt","deleted\n")
+        self.gib(["init"])
+        self.gib(["commit"])
+        # Leave deleted.txt out of the snapshot, as happens if adding it
+        # failed:
+        filename = StatSnapshot.filename(self.repository,"master")
+        snapshot = StatSnapshot.load(filename)
+        del snapshot.entries[b"deleted.txt"]
+        snapshot.save(filename)
+        os.remove(os.path.join(self.home,"deleted.txt"))
+        self.gib(["commit"])
+        files = self.git(["--git-dir=" + self.repository,"ls-tree",
+                          "--name-only","master"]).decode().split()
+        self.assertIn("kept.txt",files)
+        self.assertNotIn("deleted.txt",files)
+
+    def test_restore_only_writes_changed_files(self):
+        self.write("same.txt","same\n")
+        self.write("changed.txt","original\n")
+        self.gib(["init"])
+        self.gib(["commit"])
+        same = os.path.join(self.home,"same.txt")
+        changed = os.path.join(self.home,"changed.txt")
+        before = os.lstat(same)
+        self.write("changed.txt","modified\n")
+        self.restore()
+        with open(changed) as fp:
+            self.assertEqual(fp.read(),"original\n")
+        after = os.lstat(same)
+        self.assertEqual((before.st_ino,before.st_ctime_ns),
+                         (after.st_ino,after.st_ctime_ns))
+        self.assertEqual(
+            self.git(["--git-dir=" + self.repository,"symbolic-ref","HEAD"]),
+            b"refs/heads/master\n"
+        )
+
+    def test_branch_named_like_the_repository_store_is_rejected(self):
+        for branch in ["objects.git","objects.git/laptop"]:
+            command = [sys.executable,os.path.join(gib_directory,"gib"),
+                       "-d",self.home,"-g",self.repository,
+                       "-b",branch,"init"]
+            result = run(command,env=self.environment,stdout=PIPE,
+                         stderr=PIPE)
+            self.assertNotEqual(result.returncode,0)
+            self.assertIn(b"reserved",result.stderr)
+        self.gib(["-b","objects.gitx","init"])
+
+    def test_show_version_or_file_named_like_one(self):
+        self.write("notes","one\n")
+        self.write("notes@2","literal\n")
+        self.gib(["init"])
+        self.gib(["commit"])
+        self.write("notes","two\n")
+        self.gib(["commit"])
+        notes = os.path.join(self.home,"notes")
+        self.assertIn(b"   2 ",self.gib(["history",notes]))
+        self.assertEqual(self.gib(["show",notes + "@1"]),b"one\n")
+        self.assertEqual(self.gib(["show",notes + "@2"]),b"literal\n")
+        self.assertEqual(self.gib(["show",notes + "@2@1"]),b"literal\n")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# Tests for the reimplementation of git's ignore rules in walker.py.
+# Run them with:
+#
+#   python3 -m unittest test_walker
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from walker import walk_directory
+
+class WalkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.original_directory = os.getcwd()
+        self.directory = tempfile.mkdtemp(prefix="gib-test-walker-")
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.original_directory)
+        shutil.rmtree(self.directory)
+
+    def write(self, path, contents=""):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as fp:
+            fp.write(contents)
+
+    def walked(self, exclude_files=(), tracked=frozenset()):
+        '''Return the set of files found by walk_directory, as str'''
+        walk = walk_directory(exclude_files, tracked)
+        return set(os.fsdecode(p) for p in walk.snapshot.entries)
+
+    def test_basename_pattern_matches_in_any_directory(self):
+        self.write(".gitignore", "*.o\n")
+        self.write("a.o")
+        self.write("src/deep/b.o")
+        self.write("src/b.c")
+        self.assertEqual(self.walked(), {".gitignore", "src/b.c"})
+
+    def test_negation(self):
+        self.write(".gitignore", "*.log\n!keep.log\n")
+        self.write("keep.log")
+        self.write("other.log")
+        self.write("sub/keep.log")
+        self.write("sub/other.log")
+        self.assertEqual(self.walked(),
+                         {".gitignore", "keep.log", "sub/keep.log"})
+
+    def test_negation_cannot_reinclude_from_ignored_directory(self):
+        self.write(".gitignore", "build/\n!build/keep\n")
+        self.write("build/keep")
+        self.assertEqual(self.walked(), {".gitignore"})
+
+    def test_later_gitignore_takes_precedence(self):
+        self.write(".gitignore", "*.txt\n")
+        self.write("sub/.gitignore", "!wanted.txt\n")
+        self.write("sub/wanted.txt")
+        self.write("sub/unwanted.txt")
+        self.assertEqual(self.walked(),
+                         {".gitignore", "sub/.gitignore", "sub/wanted.txt"})
+
+    def test_directory_only_pattern(self):
+        self.write(".gitignore", "cache/\n")
+        self.write("cache/data")
+        self.write("sub/cache/data")
+        # A file with the same name isn't matched:
+        self.write("other/cache")
+        self.assertEqual(self.walked(), {".gitignore", "other/cache"})
+
+    def test_anchored_pattern(self):
+        self.write(".gitignore", "/top.txt\ndoc/*.html\n")
+        self.write("top.txt")
+        self.write("sub/top.txt")
+        self.write("doc/index.html")
+        self.write("doc/api/index.html")
+        self.write("sub/doc/index.html")
+        self.assertEqual(self.walked(),
+                         {".gitignore", "sub/top.txt", "doc/api/index.html",
+                          "sub/doc/index.html"})
+
+    def test_anchored_pattern_in_subdirectory(self):
+        self.write("sub/.gitignore", "/local\n")
+        self.write("local")
+        self.write("sub/local")
+        self.write("sub/deeper/local")
+        self.assertEqual(self.walked(),
+                         {"local", "sub/.gitignore", "sub/deeper/local"})
+
+    def test_double_asterisk(self):
+        self.write(".gitignore", "**/tmp\nlogs/**\n")
+        self.write("tmp")
+        self.write("a/b/tmp")
+        self.write("logs/x/y")
+        self.write("a/logs")
+        self.assertEqual(self.walked(), {".gitignore", "a/logs"})
+
+    def test_exclude_files_have_lower_precedence(self):
+        self.write("exclude", "*.bak\n*.swp\n")
+        self.write(".gitignore", "!*.bak\n")
+        self.write("a.bak")
+        self.write("a.swp")
+        self.assertEqual(self.walked([b"exclude"]),
+                         {".gitignore", "a.bak", "exclude"})
+
+    def test_tracked_files_are_not_ignored(self):
+        self.write(".gitignore", "*.dat\n")
+        self.write("tracked.dat")
+        self.write("untracked.dat")
+        self.assertEqual(self.walked(tracked={b"tracked.dat"}),
+                         {".gitignore", "tracked.dat"})
+
+    def test_tracked_files_in_ignored_directory(self):
+        self.write(".gitignore", "build/\n")
+        self.write("build/sub/tracked")
+        self.write("build/sub/untracked")
+        self.write("build/untracked")
+        self.assertEqual(self.walked(tracked={b"build/sub/tracked"}),
+                         {".gitignore", "build/sub/tracked"})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+# A single walk of the directory to backup, which finds in one pass:
+#
+#   - the files and symbolic links that git should consider, along
+#     with their stat information (as a StatSnapshot)
+#
+#   - the nested git repositories, which are not descended into (as
+#     find-git-repos -i would find them)
+#
+#   - the metadata for every entry that should be recorded in the
+#     .ometastore file (as "ometastore -s -i" would record it)
+#
+# Files are ignored according to git's rules: the .gitignore file in
+# each directory, then $GIT_DIR/info/exclude and then the file given by
+# core.excludesFile.  As with "git add", a file that is already in the
+# index is never ignored, even if a pattern matches it or a directory
+# that contains it.
+
+import grp
+import os
+import pwd
+import re
+import stat
+
+from metastore import MetadataEntry, kind_code
+from snapshot import StatSnapshot
+
+class IgnorePattern:
+    '''One pattern from a .gitignore (or similar) file'''
+
+    def __init__(self, line):
+        self.negated = False
+        if line.startswith(b'!'):
+            self.negated = True
+            line = line[1:]
+        elif line.startswith(b'\\'):
+            line = line[1:]
+        self.directory_only = line.endswith(b'/')
+        line = line.rstrip(b'/')
+        # A pattern with a slash anywhere except at the end is matched
+        # against the path relative to the directory of the .gitignore
+        # file; otherwise it is matched against the basename:
+        self.basename_only = b'/' not in line
+        self.regex = re.compile(wildcard_to_regex(line.lstrip(b'/')), re.DOTALL)
+
+    def matches(self, relative_path, basename, is_directory):
+        if self.directory_only and not is_directory:
+            return False
+        target = basename if self.basename_only else relative_path
+        return self.regex.fullmatch(target) is not None
+
+def wildcard_to_regex(pattern):
+    '''Translate a gitignore pattern (bytes) into a regular expression
+    (bytes), in which "*" and "?" don't match "/" and "**" matches any
+    number of directories'''
+    result = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i:i+1]
+        if pattern.startswith(b'**', i):
+            at_start = (i == 0 or pattern[i-1:i] == b'/')
+            if at_start and pattern.startswith(b'**/', i):
+                result.append(b'(?:.*/)?')
+                i += 3
+                continue
+            if at_start and i + 2 == n:
+                result.append(b'.*')
+                i += 2
+                continue
+            result.append(b'[^/]*')
+            i += 2
+        elif c == b'*':
+            result.append(b'[^/]*')
+            i += 1
+        elif c == b'?':
+            result.append(b'[^/]')
+            i += 1
+        elif c == b'[':
+            j = i + 1
+            if pattern[j:j+1] in (b'!', b'^'):
+                j += 1
+            if pattern[j:j+1] == b']':
+                j += 1
+            while j < n and pattern[j:j+1] != b']':
+                j += 1
+            if j >= n:
+                result.append(b'\\[')
+                i += 1
+            else:
+                contents = pattern[i+1:j]
+                if contents[:1] in (b'!', b'^'):
+                    contents = b'^' + contents[1:]
+                contents = contents.replace(b'\\', b'\\\\')
+                result.append(b'(?!/)[' + contents + b']')
+                i = j + 1
+        elif c == b'\\' and i + 1 < n:
+            result.append(re.escape(pattern[i+1:i+2]))
+            i += 2
+        else:
+            result.append(re.escape(c))
+            i += 1
+    return b''.join(result)
+
+def read_ignore_file(filename):
+    '''Return a list of the IgnorePatterns in "filename", or an empty
+    list if it can't be read'''
+    try:
+        with open(filename, 'rb') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+    patterns = []
+    for line in lines:
+        # Trailing spaces are ignored unless they're escaped:
+        stripped = line.rstrip(b' ')
+        if stripped.endswith(b'\\') and len(stripped) < len(line):
+            stripped += b' '
+        if not stripped or stripped.startswith(b'#'):
+            continue
+        patterns.append(IgnorePattern(stripped))
+    return patterns
+
+def is_ignored(levels, path, basename, is_directory):
+    '''"levels" is a list of (directory, patterns) tuples, in increasing
+    order of precedence.  Return True if "path" should be ignored.'''
+    for directory, patterns in reversed(levels):
+        relative_path = path[len(directory)+1:] if directory else path
+        for pattern in reversed(patterns):
+            if pattern.matches(relative_path, basename, is_directory):
+                return not pattern.negated
+    return False
+
+class Walk:
+    '''The results of walking the current directory'''
+
+    def __init__(self):
+        self.snapshot = StatSnapshot()
+        self.repositories = []
+        self.symbolic_links = set()
+        self.executables = set()
+        self.metadata = []
+        self.user_names = {}
+        self.group_names = {}
+
+    def user_name(self, uid):
+        if uid not in self.user_names:
+            try:
+                name = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                try:
+                    name = pwd.getpwuid(os.getuid()).pw_name
+                except KeyError:
+                    name = os.environ.get('USER', '')
+            self.user_names[uid] = os.fsencode(name)
+        return self.user_names[uid]
+
+    def group_name(self, gid):
+        if gid not in self.group_names:
+            try:
+                name = grp.getgrgid(gid).gr_name
+            except KeyError:
+                try:
+                    name = grp.getgrgid(os.getgid()).gr_name
+                except KeyError:
+                    name = os.environ.get('USER', '')
+            self.group_names[gid] = os.fsencode(name)
+        return self.group_names[gid]
+
+    def add_metadata(self, path, s):
+        try:
+            xattrs = [
+                (os.fsencode(name),
+                 os.getxattr(path, name, follow_symlinks=False))
+                for name in sorted(os.listxattr(path, follow_symlinks=False))
+            ]
+        except (OSError, AttributeError):
+            xattrs = []
+        self.metadata.append(MetadataEntry(
+            path,
+            self.user_name(s.st_uid),
+            self.group_name(s.st_gid),
+            s.st_mtime,
+            stat.S_IMODE(s.st_mode),
+            kind_code(s.st_mode),
+            xattrs
+        ))
+
+def leading_directories(paths):
+    '''Return the set of directories (bytes) that contain any of "paths"'''
+    directories = set()
+    for path in paths:
+        slash = path.rfind(b'/')
+        while slash > 0:
+            directory = path[:slash]
+            if directory in directories:
+                break
+            directories.add(directory)
+            slash = path.rfind(b'/', 0, slash)
+    return directories
+
+def walk_directory(exclude_files=(), tracked=frozenset()):
+    '''Walk the current directory, honouring .gitignore files and the
+    ignore files in "exclude_files", and return a Walk.  The paths in
+    "tracked" (those already in the index) are included even if they
+    are ignored.'''
+    walk = Walk()
+    base_levels = [ (b'', read_ignore_file(f)) for f in exclude_files ]
+    tracked_directories = leading_directories(tracked)
+    # Each item is (directory, levels, whether the directory is ignored):
+    stack = [ (b'', base_levels, False) ]
+    while stack:
+        directory, levels, directory_ignored = stack.pop()
+        directory_for_os = directory or b'.'
+        levels = levels + [
+            (directory,
+             read_ignore_file(os.path.join(directory_for_os, b'.gitignore')))
+        ]
+        try:
+            entries = list(os.scandir(directory_for_os))
+        except OSError:
+            continue
+        for entry in entries:
+            name = entry.name
+            if name == b'.git':
+                continue
+            path = directory + b'/' + name if directory else name
+            try:
+                s = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            is_directory = stat.S_ISDIR(s.st_mode)
+            ignored = directory_ignored or \
+                is_ignored(levels, path, name, is_directory)
+            if ignored and path in tracked:
+                ignored = False
+            # An ignored directory still has to be looked in if some of
+            # the files in it are tracked:
+            if ignored and not (is_directory and path in tracked_directories):
+                continue
+            if not ignored:
+                walk.add_metadata(path, s)
+            if is_directory:
+                if not ignored and \
+                        os.path.lexists(os.path.join(path, b'.git')):
+                    walk.repositories.append(path)
+                else:
+                    stack.append((path, levels, ignored))
+            elif stat.S_ISREG(s.st_mode) or stat.S_ISLNK(s.st_mode):
+                walk.snapshot.add(path, s)
+                if stat.S_ISLNK(s.st_mode):
+                    walk.symbolic_links.add(path)
+                elif s.st_mode & stat.S_IXUSR:
+                    walk.executables.add(path)
+    walk.repositories.sort()
+    return walk